@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Persistent per-mailbox cache of summary data, so that large
+mailboxes need not be rescanned from the start every time trm
+runs. Cache files live in $XDG_CACHE_HOME/trm (default ~/.cache/trm)
+and are named after the mailbox path. The contents are whatever
+the mailbox chooses to store; it is up to the mailbox to validate
+them against the file."""
+
+from __future__ import print_function
+
+import hashlib
+import os
+import sys
+
+from utils import writeLog
+
+PY3 = sys.version_info[0] >= 3
+if PY3:
+    import pickle
+else:
+    import cPickle as pickle
+
+CACHE_VERSION = 6       # Bump whenever the cached data changes shape
+
+def cacheDir():
+    """Return the cache directory, creating it if needed."""
+    if "TRMCACHE" in os.environ:
+        path = os.environ["TRMCACHE"]
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or \
+            os.path.join(os.path.expanduser('~'), ".cache")
+        path = os.path.join(base, "trm")
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    return path
+
+def cachePath(path, kind="summaries"):
+    """Return the cache file name for this mailbox path."""
+    path = os.path.abspath(path)
+    digest = hashlib.sha1(path.encode("utf8") if PY3 else path).hexdigest()
+    return os.path.join(cacheDir(), "%s-%s.%s" % (
+        os.path.basename(path), digest[:16], kind))
+
+def load(path, kind="summaries"):
+    """Return the cached data for this mailbox, or None."""
+    try:
+        with open(cachePath(path, kind), "rb") as ifile:
+            data = pickle.load(ifile)
+    except (IOError, OSError):
+        return None
+    except Exception as e:
+        writeLog("Failed to read %s cache for %s: %s" % (kind, path, e))
+        return None
+    if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+        return None
+    return data
+
+def save(path, data, kind="summaries"):
+    """Store data (a dict) for this mailbox. The file is replaced
+    atomically, so readers never see a partial cache."""
+    data["version"] = CACHE_VERSION
+    try:
+        filename = cachePath(path, kind)
+        tmpname = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmpname, "wb") as ofile:
+            pickle.dump(data, ofile, 2)
+        os.rename(tmpname, filename)
+        return True
+    except Exception as e:
+        writeLog("Failed to write %s cache for %s: %s" % (kind, path, e))
+        return False
+
+def remove(path, kind="summaries"):
+    """Discard the cached data for this mailbox."""
+    try:
+        os.unlink(cachePath(path, kind))
+    except OSError:
+        pass
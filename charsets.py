@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Guess the character set of 8-bit header text which doesn't say
+what it is.
+
+ASCII and UTF-8 are recognized first, the first with a regex and
+the second by decoding once. Otherwise each legacy charset is given
+a score from the frequencies of the bytes 0x80-0xff in the text:
+each byte is weighted by what it would be in that charset, a common
+letter of the language counting most and a control character or
+undefined byte ruling the charset out. The weights are tables for
+bytes.translate(), so the scoring is done in C. Text in Cyrillic,
+Greek or Hebrew comes as whole words of 8-bit bytes, so those
+charsets lose points for every 8-bit byte next to an ASCII letter,
+as in "caf\\xe9". GB2312 is scored by its characters instead, the
+3755 common ones, whose first byte is 0xb0-0xd7, counting most.
+
+The charset found for a sender is taken for the next header from the
+same address if it can be in that charset at all, since a sender
+generally sticks to one. (Not the same domain: a big mail provider's
+users write in every language.)
+
+Run this module to compare it with the old cascade of trial
+decodings on a corpus of 8-bit headers, or with mbox files as
+arguments, on their 8-bit headers."""
+
+from __future__ import print_function
+
+import re
+import sys
+import time
+import unicodedata
+
+# Candidates, in order of preference when the scores are equal
+ENCODINGS = ("GB2312", "ISO-8859-5", "windows-1251",
+    "ISO-8859-1", "windows-1252", "ISO-8859-7", "windows-1253",
+    "ISO-8859-8", "windows-1255")
+
+# The most frequent letters of the language(s) each charset is for
+COMMON = {
+    "latin": u"éèàçêâôîûëïüöäßñóáíúãõåøæÉÀÇÜÖÄ",
+    "cyrillic": u"оеаинтсрвлкмдпуяыьгзбОЕАИНТСРВЛКМДПУ",
+    "greek": u"αοειτνσηρπκυμλςάέίόήύώ",
+    "hebrew": u"אבגדהוזחטיךכלםמןנסעףפץצקרשת",
+}
+SCRIPTS = {"ISO-8859-1": "latin", "windows-1252": "latin",
+    "ISO-8859-5": "cyrillic", "windows-1251": "cyrillic",
+    "ISO-8859-7": "greek", "windows-1253": "greek",
+    "ISO-8859-8": "hebrew", "windows-1255": "hebrew",
+    "GB2312": "han"}
+
+# Byte weights
+RULED_OUT, SYMBOL, LETTER, COMMON_LETTER = range(4)
+
+SENDER_CACHE_SIZE = 10000
+
+_ascii_re = re.compile(b"[\\x00-\\x7f]*\\Z")
+_sender_re = re.compile(b"[-\\w.+=]+@[-A-Za-z0-9.]+")
+_senderText_re = re.compile(u"[-\\w.+=]+@[-A-Za-z0-9.]+")
+_asciiText_re = re.compile(u"[\\x00-\\x7f]*\\Z")
+_gb_re = re.compile(b"(?:[\\x00-\\x7f]|[\\xa1-\\xf7][\\xa1-\\xfe])*\\Z")
+_han_re = re.compile(b"([\\xb0-\\xd7])[\\xa1-\\xfe]|[\\xa1-\\xfe]{2}")
+_asciiBytes = bytes(bytearray(range(0x80)))
+# Maps ASCII letters to "a", 8-bit bytes to "h" and anything else to " "
+_classes = bytes(bytearray(ord("a") if chr(b).isalpha() else ord(" ")
+    for b in range(0x80)) + bytearray(b"h" * 0x80))
+
+def _weights(encoding):
+    """Return the translate() table of byte weights for a single
+    byte charset."""
+    common = COMMON[SCRIPTS[encoding]]
+    weights = bytearray(256)
+    for b in range(0x80, 0x100):
+        try:
+            c = bytearray([b]).decode(encoding)
+        except UnicodeDecodeError:
+            weights[b] = RULED_OUT
+            continue
+        category = unicodedata.category(c)
+        if c in common:
+            weights[b] = COMMON_LETTER
+        elif category.startswith("L"):
+            weights[b] = LETTER
+        elif category == "Cc" or category == "Cf":
+            weights[b] = RULED_OUT
+        else:
+            weights[b] = SYMBOL
+    return bytes(weights)
+
+_tables = dict((e, _weights(e)) for e in ENCODINGS if e != "GB2312")
+# (charset, weights, whether to penalize 8-bit bytes next to ASCII
+# letters) for the single byte charsets, in order
+_candidates = [(e, _tables[e], SCRIPTS[e] != "latin")
+    for e in ENCODINGS if e != "GB2312"]
+
+_senders = {}           # sender's address => charset
+
+def _fits(data, encoding):
+    """True if data can be in this charset."""
+    if encoding == "GB2312":
+        if not _gb_re.match(data):
+            return False
+        try:
+            data.decode(encoding)
+            return True
+        except UnicodeDecodeError:
+            return False
+    return b"\x00" not in data.translate(_tables[encoding], _asciiBytes)
+
+def guess(data, sender=None):
+    """Return the charset of data, a byte string: "ascii", "utf8",
+    one of ENCODINGS, or None if none fits. sender is the sender's
+    address, if known."""
+    if _ascii_re.match(data):
+        return "ascii"
+    try:
+        data.decode("utf8")
+        return "utf8"
+    except UnicodeDecodeError:
+        pass
+    known = _senders.get(sender)
+    if known is not None and _fits(data, known):
+        return known
+    # Score each charset by the sum of the weights of the 8-bit bytes,
+    # less three for each one next to an ASCII letter if the charset
+    # isn't for a Latin alphabet.
+    classes = data.translate(_classes)
+    penalty = 3 * (classes.count(b"ah") + classes.count(b"ha"))
+    best, encoding = None, None
+    if _fits(data, "GB2312"):
+        chars = _han_re.findall(data)
+        best = 6 * len(chars) - 2 * chars.count(b"") - penalty
+        encoding = "GB2312"
+    high = data.translate(None, _asciiBytes)
+    for e, table, penalized in _candidates:
+        w = high.translate(table)
+        if b"\x00" not in w:
+            score = sum(bytearray(w)) - (penalty if penalized else 0)
+            if best is None or score > best:
+                best, encoding = score, e
+    if sender and encoding:
+        if len(_senders) >= SENDER_CACHE_SIZE:
+            _senders.clear()
+        _senders[sender] = encoding
+    return encoding
+
+def decode(data, sender=None):
+    """Return data, a byte string, as unicode, or None if no charset
+    fits."""
+    encoding = guess(data, sender)
+    return data.decode(encoding) if encoding else None
+
+def sender(fromHeader):
+    """Return the lower-case address of a raw From header, or None."""
+    pattern = _sender_re if isinstance(fromHeader, bytes) else _senderText_re
+    mo = pattern.search(fromHeader)
+    return mo.group(0).lower() if mo else None
+
+def isAscii(s):
+    """True if s, bytes or text, is all ASCII."""
+    pattern = _ascii_re if isinstance(s, bytes) else _asciiText_re
+    return pattern.match(s) is not None
+
+
+# Benchmark
+
+OLD_ENCODINGS = ["utf8", "GB2312", "HZ-GB-2312",
+    "ISO-8859-5", "windows-1251",
+    "ISO-8859-1", "windows-1252",
+    "ISO-8859-7", "windows-1253",
+    "ISO-8859-8", "windows-1255",]
+
+def _oldToU(s):
+    """What utils.toU() used to do."""
+    try:
+        return s.decode("ascii")
+    except UnicodeDecodeError:
+        for encoding in OLD_ENCODINGS:
+            try:
+                return s.decode(encoding)
+            except UnicodeDecodeError:
+                pass
+    return None
+
+SAMPLES = [
+    (u"Réunion de l'équipe à 15h", "fr", ("ISO-8859-1", "windows-1252")),
+    (u"Hélène Dupré <helene@example.fr>", "fr", ("ISO-8859-1",)),
+    (u"Grève générale : ça continue", "fr", ("windows-1252",)),
+    (u"Größe der Übersicht für März", "de", ("ISO-8859-1", "windows-1252")),
+    (u"Jürgen Müller <jm@example.de>", "de", ("ISO-8859-1",)),
+    (u"Schöne Grüße aus Köln", "de", ("windows-1252",)),
+    (u"Año nuevo, señor Muñoz", "es", ("ISO-8859-1",)),
+    (u"Información sobre la reunión", "es", ("windows-1252",)),
+    (u"Don’t miss our “special” offer – €10", "com", ("windows-1252",)),
+    (u"Привет, как дела?", "ru", ("windows-1251", "ISO-8859-5")),
+    (u"Отчёт о продажах за март", "ru", ("windows-1251", "ISO-8859-5")),
+    (u"Сергей Иванов <sergei@example.ru>", "ru", ("windows-1251",)),
+    (u"Встреча в пятницу", "ru", ("windows-1251", "ISO-8859-5")),
+    (u"Καλημέρα σε όλους", "gr", ("ISO-8859-7", "windows-1253")),
+    (u"Συνάντηση την Τρίτη", "gr", ("ISO-8859-7",)),
+    (u"Γιώργος Παπαδόπουλος", "gr", ("windows-1253",)),
+    (u"שלום לכולם", "il", ("ISO-8859-8", "windows-1255")),
+    (u"פגישה ביום שלישי", "il", ("windows-1255",)),
+    (u"דוד כהן <david@example.co.il>", "il", ("ISO-8859-8",)),
+    (u"你好，请查收附件", "cn", ("GB2312",)),
+    (u"会议通知", "cn", ("GB2312",)),
+    (u"关于下周的工作安排", "cn", ("GB2312",)),
+    (u"张伟 <zhang@example.cn>", "cn", ("GB2312",)),
+    (u"Zürich – Ελλάδα – Москва", "net", ("utf8",)),
+    (u"Weekly status report", "org", ("ascii",)),
+]
+
+def _corpus():
+    """(sender, bytes, text) for every sample in each of its charsets,
+    each sent by a few senders. They all share one mail provider."""
+    corpus = []
+    for text, country, encodings in SAMPLES:
+        for encoding in encodings:
+            for i in range(3):
+                sender = "%s.%s%d@mail.example.com" % (country,
+                    encoding.lower(), i)
+                corpus.append((sender, text.encode(encoding), text))
+    return corpus
+
+def _readHeaders(paths):
+    """(sender, bytes, None) for each 8-bit header line in these
+    mailboxes."""
+    corpus = []
+    for path in paths:
+        with open(path, "rb") as ifile:
+            inHeaders = False
+            headers = []
+            for line in ifile:
+                if line.startswith(b"From "):
+                    inHeaders = True
+                    headers = []
+                elif inHeaders and not line.strip():
+                    inHeaders = False
+                    address = None
+                    for header in headers:
+                        if header[:5].lower() == b"from:":
+                            address = sender(header)
+                    corpus.extend((address, header, None) for header in headers
+                        if not _ascii_re.match(header))
+                elif inHeaders:
+                    headers.append(line.rstrip())
+    return corpus
+
+def main():
+    corpus = _readHeaders(sys.argv[1:]) if sys.argv[1:] else _corpus()
+    if not corpus:
+        print("No 8-bit headers found")
+        return 1
+    rounds = max(1, 20000 // len(corpus))
+    results = {}
+    for name, convert in (("old cascade", lambda d, b: _oldToU(b)),
+            ("guess, no sender", lambda d, b: decode(b)),
+            ("guess, by sender", lambda d, b: decode(b, d))):
+        _senders.clear()
+        start = time.time()
+        for i in range(rounds):
+            out = [convert(d, b) for d, b, t in corpus]
+        elapsed = time.time() - start
+        results[name] = out
+        right = sum(1 for (d, b, t), o in zip(corpus, out) if o == t)
+        print("%-18s %6.2f us/header" %
+            (name, 1e6 * elapsed / rounds / len(corpus)), end="")
+        if corpus[0][2] is not None:
+            print(", %d of %d right" % (right, len(corpus)))
+        else:
+            print()
+    if corpus[0][2] is None:
+        same = sum(1 for a, b in zip(results["old cascade"],
+            results["guess, by sender"]) if a == b)
+        print("%d of %d headers decoded the same" % (same, len(corpus)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Parse the Date headers of messages into Unix time.
+
+Nearly every Date header is in the one format RFC 5322 recommends,
+e.g. "Tue, 16 Jun 2026 14:03:27 +0200", and those are parsed with a
+single precompiled regex and calendar.timegm(). Anything else goes
+to email.utils.parsedate_tz(). Either way the result is the same as
+email.utils.mktime_tz(): the time in UTC, or if the header has no
+zone, local time.
+
+The same Date header often occurs many times in one mailbox (a
+message cross-posted to several lists, or filed twice), so recent
+results are kept in a small cache.
+
+Run this module with mbox files as arguments to time it against
+the stdlib on their Date headers."""
+
+from __future__ import print_function
+
+import calendar
+import email.utils
+import re
+import sys
+import time
+
+CACHE_SIZE = 4096
+
+MONTHS = dict((m, i+1) for i,m in enumerate(("jan", "feb", "mar", "apr",
+    "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")))
+
+# Offsets of the zone names RFC 5322 allows, in minutes
+ZONES = {"ut": 0, "utc": 0, "gmt": 0, "z": 0,
+    "est": -300, "edt": -240, "cst": -360, "cdt": -300,
+    "mst": -420, "mdt": -360, "pst": -480, "pdt": -420}
+
+_date_re = re.compile(r"""\s*(?:[a-z]{3},\s*)?
+    (\d{1,2})\s+([a-z]{3})\s+(\d{4})\s+         # day month year
+    (\d{1,2}):(\d\d)(?::(\d\d))?\s+             # hh:mm:ss
+    ([+-]\d{4}|[a-z]{1,3})                       # zone
+    \s*(?:\([^()]*\)\s*)?$""", re.I | re.X)
+
+_cache = {}
+_missing = object()
+_monthStarts = {}       # (year, month) as in the header => Unix time
+_zoneOffsets = {}       # zone as in the header => offset in seconds
+
+def parseDate(value):
+    """Return the Unix time of a Date header, or None if it can't
+    be parsed."""
+    if not value:
+        return None
+    result = _cache.get(value, _missing)
+    if result is _missing:
+        result = _parseFast(value)
+        if result is None:
+            result = _parseSlow(value)
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[value] = result
+    return result
+
+def _parseFast(value):
+    mo = _date_re.match(value)
+    if mo is None:
+        return None
+    day, month, year, hour, minute, second, zone = mo.groups()
+    # The start of the month and the zone offset are looked up
+    # from the text, since only a few distinct ones occur.
+    start = _monthStarts.get((year, month))
+    if start is None:
+        start = _monthStart(year, month)
+        if start is None:
+            return None
+    offset = _zoneOffsets.get(zone)
+    if offset is None:
+        offset = _zoneOffset(zone)
+        if offset is None:
+            return None
+    hour, minute = int(hour), int(minute)
+    second = int(second) if second else 0
+    if hour > 23 or minute > 59 or second > 60:
+        return None
+    return start + (int(day) - 1) * 86400 + hour * 3600 + minute * 60 + \
+        second - offset
+
+def _monthStart(year, month):
+    m = MONTHS.get(month.lower())
+    if m is None:
+        return None
+    start = _monthStarts[(year, month)] = \
+        calendar.timegm((int(year), m, 1, 0, 0, 0, 0, 1, 0))
+    return start
+
+def _zoneOffset(zone):
+    if zone[0] in "+-":
+        offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+        if zone[0] == '-':
+            offset = -offset
+    else:
+        offset = ZONES.get(zone.lower())
+        if offset is None:
+            return None
+        offset *= 60
+    _zoneOffsets[zone] = offset
+    return offset
+
+def _parseSlow(value):
+    try:
+        st = email.utils.parsedate_tz(value)
+        if st is None:
+            return None
+        return email.utils.mktime_tz(st)
+    except (ValueError, OverflowError, TypeError):
+        return None
+
+
+def _oldParse(value):
+    """What messageSummary.parseDate() used to do, for comparison.
+    (It applied the zone offset backwards.)"""
+    st = email.utils.parsedate_tz(value)
+    if st is None:
+        return 0
+    udate = time.mktime(st[:9])
+    if st[9]:
+        udate += st[9]
+    return udate
+
+def _readDates(paths):
+    values = []
+    for path in paths:
+        with open(path, "r") as ifile:
+            for line in ifile:
+                if line[:5].lower() == "date:":
+                    values.append(line[5:].strip())
+    return values
+
+def _sampleDates(n):
+    """Made-up Date headers, mostly in the usual format."""
+    values = []
+    t = 1.7e9
+    zones = ("+0000", "-0700", "+0200", "+0530", "GMT", "-0400 (EDT)")
+    for i in range(n):
+        t += 3607
+        zone = zones[i % len(zones)]
+        if i % 50 == 0:
+            values.append(time.strftime("%d %b %y %H:%M", time.gmtime(t)))
+        else:
+            values.append(time.strftime("%a, %d %b %Y %H:%M:%S ",
+                time.gmtime(t)) + zone)
+    return values
+
+def main():
+    values = _readDates(sys.argv[1:]) if sys.argv[1:] else _sampleDates(100000)
+    if not values:
+        print("No Date headers found")
+        return 1
+    print("%d Date headers, %d distinct" % (len(values), len(set(values))))
+    def timing(parse, clear=False):
+        best = None
+        for i in range(3):
+            if clear:
+                _cache.clear()
+            start = time.time()
+            for value in values:
+                parse(value)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    timings = []
+    for name, parse, clear in (
+            ("parsedate_tz + mktime (old)", _oldParse, False),
+            ("parsedate_tz + mktime_tz", _parseSlow, False),
+            ("fast path only", _parseFast, False),
+            ("parseDate, cold cache", parseDate, True),
+            ("parseDate, second pass", parseDate, False)):
+        timings.append(timing(parse, clear))
+        print("%-30s %7.2f us/header" % (name, 1e6 * timings[-1] / len(values)))
+    fast = sum(1 for v in values if _parseFast(v) is not None)
+    wrong = sum(1 for v in values if parseDate(v) != _parseSlow(v))
+    moved = sum(1 for v in values if _oldParse(v) != (parseDate(v) or 0))
+    print("%.1f%% took the fast path; %d differ from mktime_tz()" %
+        (100. * fast / len(values), wrong))
+    print("%d differ from the old code, which applied zones backwards" % moved)
+    print("speedup over the old code: %.1fx, %.1fx on the second pass" %
+        (timings[0] / timings[3], timings[0] / timings[4]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Find duplicate messages in a mailbox. Two messages are duplicates
+if they have the same Message-ID and the same body. The headers are
+not compared, since copies of one message that arrive by different
+routes (e.g. cross-posted to two lists) have different Received and
+List- headers.
+
+Only messages whose Message-ID occurs more than once need their
+bodies compared. The body digest is computed by reading the body's
+byte range from the mailbox file a block at a time, without parsing
+the message, and is kept in the summary so that it is saved in the
+cache with the other summary data."""
+
+from __future__ import print_function
+
+import hashlib
+import time
+
+import msgindex
+from emailaccount import messageSummary
+from utils import writeLog
+
+BLOCK = 64 << 10
+
+def bodyDigest(ifile, summary):
+    """Return the hex digest of the body of this message, read from
+    ifile, which must be opened in binary mode. Trailing line breaks
+    are not included, as the last message in a file may lack the
+    blank line which separates the others."""
+    ifile.seek(summary.offset)
+    remaining = summary.size
+    while remaining > 0:
+        line = ifile.readline(remaining)
+        if not line:
+            break
+        remaining -= len(line)
+        if line in (b"\n", b"\r\n"):
+            break
+    digest = hashlib.sha1()
+    pending = b""
+    while remaining > 0:
+        block = ifile.read(min(BLOCK, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        body = block.rstrip(b"\r\n")
+        if body:
+            digest.update(pending)
+            digest.update(body)
+            pending = block[len(body):]
+        else:
+            pending += block
+    return digest.hexdigest()
+
+def findDuplicates(mbox, callback=None):
+    """Return (status, duplicates), where duplicates is the list of
+    messages, not already flagged deleted, which duplicate an earlier
+    message in the mailbox. The optional callback(mbox, count, pct,
+    status, msg) is called every 0.5 seconds or so while digests are
+    being computed, and at the conclusion. status is one of the
+    mailbox STATE_ constants; if interrupted, the duplicates found
+    so far are returned."""
+    FLAG_DELETED = messageSummary.FLAG_DELETED
+    byId = {}
+    for summary in mbox.summaries() or ():
+        if summary.status & FLAG_DELETED:
+            continue
+        msgid = msgindex.normalize(summary.MessageId)
+        if msgid:
+            byId.setdefault(msgid, []).append(summary)
+    groups = [group for group in byId.values() if len(group) > 1]
+    todo = [s for group in groups for s in group if s.digest is None]
+    start = lastcb = time.time()
+    status = mbox.STATE_FINISHED
+    count = 0
+    try:
+        if todo:
+            with open(mbox.path, "rb") as ifile:
+                for summary in todo:
+                    summary.digest = bodyDigest(ifile, summary)
+                    count += 1
+                    now = time.time()
+                    if callback and now > lastcb + 0.5:
+                        lastcb = now
+                        callback(mbox, count, 100.*count/len(todo),
+                            mbox.STATE_READING, None)
+    except KeyboardInterrupt:
+        status = mbox.STATE_INTERRUPTED
+    except (IOError, OSError) as e:
+        writeLog("dedupe: failed to read %s: %s" % (mbox.path, e))
+        status = mbox.STATE_INTERRUPTED
+    if count:
+        mbox.saveCache()
+    duplicates = []
+    for group in groups:
+        seen = set()
+        for summary in group:
+            if summary.digest is None:
+                continue
+            if summary.digest in seen:
+                duplicates.append(summary)
+            else:
+                seen.add(summary.digest)
+    elapsed = max(time.time() - start, 1e-6)
+    report = "%d duplicates; %d of %d candidates read in %.2fs" % \
+        (len(duplicates), count, sum(len(g) for g in groups), elapsed)
+    writeLog("%s: %s" % (mbox.name, report))
+    if callback:
+        callback(mbox, len(duplicates), 100., status,
+            "Interrupted by user" if status != mbox.STATE_FINISHED else report)
+    return status, duplicates
@@ -3,6 +3,9 @@
 
 from __future__ import print_function
 
+import array
+import binascii
+import bisect
 import email.header
 import email.utils
 import os
@@ -10,6 +13,8 @@ import re
 import sys
 import time
 
+import charsets
+import dates
 from utils import writeLog, human_readable, toU
 
 PY3 = sys.version_info[0] >= 3
@@ -34,6 +39,8 @@ class emailAccount(object):
     def __init__(self, name):
         self._name = name
         self.boxes = []
+        self.searches = []      # virtual folders
+        self.msgIndex = None    # Message-ID index, if supported
         self.acctType = None
     @property
     def name(self):
@@ -54,6 +61,10 @@ class emailAccount(object):
         """Return the list of mailboxes previously obtained
         by getMboxes()."""
         return self.boxes
+    def folders(self):
+        """Return the mailboxes previously obtained by getMboxes(),
+        followed by the account's saved searches, if any."""
+        return self.boxes + self.searches
 
 
 class mailbox(object):
@@ -88,6 +99,8 @@ class mailbox(object):
         self.nNew = None
         self.modified = True
         self.deleted = []
+        self.listeners = []
+        self._resetIndexes()
     @property
     def name(self):
         return self._name
@@ -121,34 +134,412 @@ class mailbox(object):
 #            del self._summaries[idx]
 #            # TODO: create an "undo" object
 #        return self
+    def ownerOf(self, summary):
+        """Return the mailbox which actually holds this message."""
+        return self
+    def addListener(self, listener):
+        """Arrange for listener(mailbox, event, summary) to be called
+        when a message is appended ("append"), a message's flags
+        change ("flags"), the summary list is replaced ("reset"), or
+        the summaries have been saved to the cache ("saved"). The
+        summary is None for the last two, and for "flags" when a bulk
+        change has changed the flags of many messages at once."""
+        self.listeners.append(listener)
+    def removeListener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+    def _notify(self, event, summary=None):
+        for listener in self.listeners:
+            listener(self, event, summary)
     def chFlags(self, idx, toSet, toClear, toToggle=0):
         """Change the flags on an entry in the mailbox. This can
         affect the counts of new and unread messages."""
         if idx >= 0 and idx < len(self._summaries):
-            summary = self._summaries[idx]
-            newStatus = status = summary.status
-            newStatus |= toSet
-            newStatus &= ~toClear
-            newStatus ^= toToggle
-            #writeLog("change flags of item %d, %s %x => %x" % (idx, summary.Subject, status, newStatus))
-            summary.status = newStatus
-            summary.modified = True
-            self.modified = True
-            changed = status ^ newStatus
-            #writeLog("old: %#x, new: %#x, changed: %#x" % (status, newStatus, changed))
-            if self.nNew is not None and changed & messageSummary.FLAG_NEW:
-                self.nNew += 1 if newStatus & messageSummary.FLAG_NEW else -1
-            if self.nUnread is not None and changed & messageSummary.FLAG_READ:
-                self.nUnread += -1 if newStatus & messageSummary.FLAG_READ else 1
-            if changed & messageSummary.FLAG_DELETED:
-                delta = -1 if newStatus & messageSummary.FLAG_DELETED else 1
-                #writeLog("  deleted, delta=%d" % delta)
-                if self.nNew is not None and newStatus & messageSummary.FLAG_NEW:
-                    self.nNew += delta
-                if self.nUnread is not None and not (newStatus & messageSummary.FLAG_READ):
-                    self.nUnread += delta
-            #writeLog("nNew now %d, nUnread now %d" % (self.nNew, self.nUnread))
+            self.chFlagsSummary(self._summaries[idx], toSet, toClear, toToggle)
+        return self
+    def chFlagsSummary(self, summary, toSet, toClear, toToggle=0):
+        """Same as chFlags(), but given the message summary rather
+        than its index."""
+        newStatus = status = summary.status
+        newStatus |= toSet
+        newStatus &= ~toClear
+        newStatus ^= toToggle
+        #writeLog("change flags of item %d, %s %x => %x" % (summary.idx, summary.Subject, status, newStatus))
+        summary.status = newStatus
+        self.modified = True
+        changed = status ^ newStatus
+        #writeLog("old: %#x, new: %#x, changed: %#x" % (status, newStatus, changed))
+        wasNew, wasUnread = self._counts(status)
+        isNew, isUnread = self._counts(newStatus)
+        if self.nNew is not None:
+            self.nNew += isNew - wasNew
+        if self.nUnread is not None:
+            self.nUnread += isUnread - wasUnread
+        if changed & messageSummary.FLAG_DELETED:
+            if newStatus & messageSummary.FLAG_DELETED:
+                self._unindexSummary(summary)
+            else:
+                self._indexSummary(summary)
+        elif changed & messageSummary.FLAG_READ and \
+                not newStatus & messageSummary.FLAG_DELETED and \
+                self.unreadSubjects is not None:
+            for key in self.limitKeys("subject", summary):
+                if newStatus & messageSummary.FLAG_READ:
+                    _indexDrop(self.unreadSubjects, key, summary.idx)
+                else:
+                    _indexAdd(self.unreadSubjects, key, summary.idx)
+        #writeLog("nNew now %d, nUnread now %d" % (self.nNew, self.nUnread))
+        if changed:
+            self._notify("flags", summary)
         return self
+    @staticmethod
+    def _counts(status):
+        """Return what a message with this status adds to (nNew,
+        nUnread). Messages flagged deleted aren't counted."""
+        if status & messageSummary.FLAG_DELETED:
+            return 0, 0
+        return int(bool(status & messageSummary.FLAG_NEW)), \
+            int(not status & messageSummary.FLAG_READ)
+    def deleteSummaries(self, summaries):
+        """Flag all of these messages deleted. Same as calling
+        chFlagsSummary() on each, but the secondary indexes are
+        updated in one pass. Returns the number newly deleted."""
+        FLAG_DELETED = messageSummary.FLAG_DELETED
+        summaries = [s for s in summaries if not s.status & FLAG_DELETED]
+        if not summaries:
+            return 0
+        for summary in summaries:
+            status = summary.status
+            summary.status |= FLAG_DELETED
+            if self.nNew is not None and status & messageSummary.FLAG_NEW:
+                self.nNew -= 1
+            if self.nUnread is not None and not status & messageSummary.FLAG_READ:
+                self.nUnread -= 1
+        self._unindexSummaries(summaries)
+        self.modified = True
+        for summary in summaries:
+            self._notify("flags", summary)
+        return len(summaries)
+
+    # Bulk flag changes. These work on the flag array, which holds
+    # the status of every message by position and which the summaries
+    # read their status from, so that marking a whole mailbox read,
+    # say, is a few passes over the array in C. Only a change to
+    # fewer than BULK_CHANGE messages visits each one, to keep the
+    # indexes in step and tell the listeners; a bigger one marks the
+    # unread subject index stale and sends a single "flags" event.
+    # Flagging messages deleted or undeleted always visits them, as
+    # the secondary indexes leave out deleted messages. Subclasses
+    # which hold messages keep the array in step with the summaries,
+    # as they do the indexes below.
+    BULK_CHANGE = 64
+    def chFlagsMany(self, summaries, toSet, toClear, toToggle=0):
+        """Same as chFlagsSummary() on each of these messages, but
+        all at once. Returns the number of messages whose flags
+        changed."""
+        return self._chFlagsMask(
+            self.flagArray.mask([s.idx for s in summaries]),
+            toSet, toClear, toToggle)
+    def chFlagsRange(self, start, end, toSet, toClear, toToggle=0):
+        """Change the flags of the messages from position start up
+        to end, all at once. Returns the number whose flags changed."""
+        return self._chFlagsMask(self.flagArray.rangeMask(start, end),
+            toSet, toClear, toToggle)
+    def chFlagsAll(self, toSet, toClear, toToggle=0):
+        """Change the flags of every message in the mailbox, e.g. to
+        mark them all read."""
+        return self.chFlagsRange(0, self.nmessages(), toSet, toClear, toToggle)
+    def _chFlagsMask(self, mask, toSet, toClear, toToggle):
+        FLAG_DELETED = messageSummary.FLAG_DELETED
+        FLAG_READ = messageSummary.FLAG_READ
+        flags = self.flagArray
+        old = flags.words
+        diff = flags.change(mask, toSet, toClear, toToggle)
+        count = flags.nChanged(diff)
+        if not count:
+            return 0
+        bulk = count >= self.BULK_CHANGE
+        if bulk and (toSet | toClear | toToggle) & FLAG_READ:
+            self.unreadSubjects = None
+        if not bulk or (toSet | toClear | toToggle) & FLAG_DELETED:
+            summaries = self._summaries
+            changed = [(summaries[pos], old[pos])
+                for pos in flags.positions(diff)]
+            self._unindexSummaries([s for s,status in changed
+                if s.status & FLAG_DELETED and not status & FLAG_DELETED])
+            for summary, status in changed:
+                newStatus = summary.status
+                if newStatus & FLAG_DELETED:
+                    continue
+                if status & FLAG_DELETED:
+                    self._indexSummary(summary)
+                elif (status ^ newStatus) & FLAG_READ and \
+                        self.unreadSubjects is not None:
+                    for key in self.limitKeys("subject", summary):
+                        if newStatus & FLAG_READ:
+                            _indexDrop(self.unreadSubjects, key, summary.idx)
+                        else:
+                            _indexAdd(self.unreadSubjects, key, summary.idx)
+        self._recount()
+        self.modified = True
+        if bulk:
+            self._notify("flags")
+        else:
+            for summary, status in changed:
+                self._notify("flags", summary)
+        return count
+    def _recount(self):
+        """Set nNew and nUnread from the flag array."""
+        FLAG_DELETED = messageSummary.FLAG_DELETED
+        FLAG_NEW = messageSummary.FLAG_NEW
+        FLAG_READ = messageSummary.FLAG_READ
+        flags = self.flagArray
+        self.nNew = flags.count(FLAG_NEW|FLAG_DELETED, FLAG_NEW)
+        self.nUnread = flags.count(FLAG_READ|FLAG_DELETED, 0)
+
+    # Secondary indexes. Each maps a normalized sender address,
+    # recipient address, or subject to the ascending list of
+    # positions in _summaries of the messages which have it.
+    # Messages flagged deleted are left out. unreadSubjects is the
+    # same as the subject index, but only for the unread messages;
+    # it is None when a bulk change has left it to be rebuilt.
+    # Subclasses call _indexSummary() as summaries are appended and
+    # _resetIndexes() when the summary list is replaced.
+    LIMITS = ("sender", "recipient", "subject")
+    def _resetIndexes(self):
+        self.indexes = dict((kind, {}) for kind in self.LIMITS)
+        self.unreadSubjects = {}
+        self.flagArray = FlagArray()
+        self.dateIndex = None
+        self.keyCache = {}
+        self.rankCache = {}
+        self.sortCache = {}
+    @staticmethod
+    def limitKeys(kind, summary):
+        """Return the index keys of this message for the given kind
+        of limit."""
+        if kind == "sender":
+            return [key for key in (normalizeAddress(summary.From),) if key]
+        if kind == "recipient":
+            return addressList(summary.To)
+        subject = normalizeSubject(summary.Subject)
+        return [subject] if subject else []
+    def _indexSummary(self, summary):
+        """Add this message to the secondary indexes. Appending in
+        order is the common case, and is constant time."""
+        if summary.status & messageSummary.FLAG_DELETED:
+            return
+        pos = summary.idx
+        for kind in self.LIMITS:
+            index = self.indexes[kind]
+            for key in self.limitKeys(kind, summary):
+                _indexAdd(index, key, pos)
+        if not summary.status & messageSummary.FLAG_READ and \
+                self.unreadSubjects is not None:
+            for key in self.limitKeys("subject", summary):
+                _indexAdd(self.unreadSubjects, key, pos)
+    def _unindexSummary(self, summary):
+        pos = summary.idx
+        for kind in self.LIMITS:
+            index = self.indexes[kind]
+            for key in self.limitKeys(kind, summary):
+                _indexDrop(index, key, pos)
+        if self.unreadSubjects is not None:
+            for key in self.limitKeys("subject", summary):
+                _indexDrop(self.unreadSubjects, key, pos)
+    def _unindexSummaries(self, summaries):
+        """Same as _unindexSummary() on each of these messages, but
+        each index list they're on is rewritten once."""
+        removed = {}            # (kind, key) => positions to remove
+        unread = self.unreadSubjects
+        for summary in summaries:
+            for kind in self.LIMITS:
+                for key in self.limitKeys(kind, summary):
+                    removed.setdefault((kind, key), set()).add(summary.idx)
+            if unread is not None:
+                for key in self.limitKeys("subject", summary):
+                    _indexDrop(unread, key, summary.idx)
+        for (kind, key), positions in removed.items():
+            index = self.indexes[kind]
+            kept = [pos for pos in index.get(key, ()) if pos not in positions]
+            if kept:
+                index[key] = kept
+            else:
+                index.pop(key, None)
+    def _indexUnread(self):
+        """Rebuild the unread subject index from the flag array."""
+        FLAG_DELETED = messageSummary.FLAG_DELETED
+        FLAG_READ = messageSummary.FLAG_READ
+        summaries = self._summaries
+        self.unreadSubjects = unread = {}
+        for pos in self.flagArray.matching(FLAG_READ|FLAG_DELETED, 0):
+            for key in self.limitKeys("subject", summaries[pos]):
+                _indexAdd(unread, key, pos)
+    def limitTo(self, kind, key):
+        """Return the messages, not flagged deleted, whose sender,
+        recipient, or subject (per kind) matches key. Takes time
+        proportional to the number of messages returned."""
+        summaries = self._summaries
+        return [summaries[i] for i in self.indexes[kind].get(key, ())]
+    def unreadWithSubject(self, summary, direction=1):
+        """Generate the unread messages, not flagged deleted, with the
+        same subject as this one which follow it (direction 1) or
+        precede it (-1) in the mailbox, nearest first. The first is
+        found in O(log n)."""
+        pos = summary.idx
+        summaries = self._summaries
+        if self.unreadSubjects is None:
+            self._indexUnread()
+        for key in self.limitKeys("subject", summary):
+            positions = self.unreadSubjects.get(key, ())
+            if direction > 0:
+                i = bisect.bisect_right(positions, pos)
+                while i < len(positions):
+                    yield summaries[positions[i]]
+                    i += 1
+            else:
+                i = bisect.bisect_left(positions, pos)
+                while i > 0:
+                    i -= 1
+                    yield summaries[positions[i]]
+
+    # The date index holds the udate of every message, ascending,
+    # and the positions in _summaries of the corresponding messages.
+    # Deleted messages are included. It is brought up to date when
+    # used, which costs nothing for mail that arrives in date order.
+    # It is built by sorting, as is a large batch of new mail, since
+    # inserting messages one at a time out of order is quadratic.
+    def _dateIndex(self):
+        summaries = self._summaries or []
+        index = self.dateIndex
+        if index is None or index[0] is not summaries or \
+                len(index[2]) > len(summaries):
+            index = self.dateIndex = (summaries, array.array('d'),
+                array.array('l'))
+        dates, positions = index[1:]
+        if len(summaries) - len(positions) > max(len(positions) // 8, 64):
+            order = sorted(range(len(summaries)),
+                key=lambda i: summaries[i].udate or 0)
+            dates = array.array('d', [summaries[i].udate or 0 for i in order])
+            positions = array.array('l', order)
+            self.dateIndex = (summaries, dates, positions)
+            return dates, positions
+        for i in range(len(positions), len(summaries)):
+            udate = summaries[i].udate or 0
+            if not dates or udate >= dates[-1]:
+                dates.append(udate)
+                positions.append(i)
+            else:
+                j = bisect.bisect_right(dates, udate)
+                dates.insert(j, udate)
+                positions.insert(j, i)
+        return dates, positions
+    def dateRange(self, start=None, end=None):
+        """Return the messages dated from start up to but not including
+        end (Unix times, either may be None), in date order. Takes
+        time proportional to the number of messages returned."""
+        dates, positions = self._dateIndex()
+        lo = 0 if start is None else bisect.bisect_left(dates, start)
+        hi = len(dates) if end is None else bisect.bisect_left(dates, end)
+        summaries = self._summaries
+        return [summaries[positions[i]] for i in range(lo, hi)]
+    def datesFrom(self, start):
+        """Generate the messages dated start or later, in date order."""
+        dates, positions = self._dateIndex()
+        summaries = self._summaries
+        for i in range(bisect.bisect_left(dates, start), len(positions)):
+            yield summaries[positions[i]]
+
+    # Sorting. Each kind of sort has a collation key per message,
+    # computed once and kept. The keys of all the messages are ranked, and a sort by
+    # several keys is then a single sort of positions on a tuple of
+    # ranks. Ranks and the resulting permutations are kept until the
+    # mailbox changes. Ties are left in mailbox order.
+    SORTS = ("subject", "sender", "recipient", "date", "size", "thread")
+    MAX_SORTS = 8           # permutations kept
+    def positionOf(self, summary):
+        """Return the position of this message in summaries()."""
+        return summary.idx
+    def collationKey(self, kind, summary):
+        """Return the key by which this message is sorted, for any
+        kind of sort but thread."""
+        if kind == "subject":
+            return normalizeSubject(summary.Subject)
+        if kind == "sender":
+            return normalizeAddress(summary.From)
+        if kind == "recipient":
+            to = addressList(summary.To)
+            return to[0] if to else u""
+        if kind == "date":
+            return summary.udate or 0
+        if kind == "size":
+            return summary.size
+        raise ValueError("no collation key for %s" % kind)
+    def collationKeys(self, kind):
+        """Return the collation keys of all the messages, by position.
+        The list is extended as mail arrives."""
+        summaries = self._summaries or []
+        cached = self.keyCache.get(kind)
+        if cached is None or cached[0] is not summaries or \
+                len(cached[1]) > len(summaries):
+            cached = self.keyCache[kind] = (summaries, [])
+        keys = cached[1]
+        if len(keys) < len(summaries):
+            keys.extend([self.collationKey(kind, s)
+                for s in summaries[len(keys):]])
+        return keys
+    def _threadKeys(self, summaries):
+        # Each message's place in the mailbox's threads, as the
+        # threaded view shows them
+        import threads          # (which imports this module)
+        order = threads.get(self).flatten(summaries)[0]
+        keys = array.array('l', [0]) * len(summaries)
+        for i, summary in enumerate(order):
+            keys[self.positionOf(summary)] = i
+        return keys
+    def sortRanks(self, kind):
+        """Return an array giving, for each message position, the rank
+        of the message's collation key among all the messages in the
+        mailbox. Messages with equal keys have equal rank."""
+        summaries = self._summaries or []
+        cached = self.rankCache.get(kind)
+        if cached and cached[0] is summaries and cached[1] == len(summaries):
+            return cached[2]
+        if kind == "thread":
+            keys = self._threadKeys(summaries)
+        else:
+            keys = self.collationKeys(kind)
+        ranks = array.array('l', [0]) * len(keys)
+        rank, prev = -1, None
+        for pos in sorted(range(len(keys)), key=keys.__getitem__):
+            if rank < 0 or keys[pos] != prev:
+                rank += 1
+                prev = keys[pos]
+            ranks[pos] = rank
+        self.rankCache[kind] = (summaries, len(summaries), ranks)
+        return ranks
+    def sortPermutation(self, keys):
+        """Return the positions of all the messages, sorted per keys,
+        a sequence of (kind, reverse) pairs."""
+        summaries = self._summaries or []
+        keys = tuple(keys)
+        cached = self.sortCache.get(keys)
+        if cached and cached[0] is summaries and cached[1] == len(summaries):
+            return cached[2]
+        ranks = [(self.sortRanks(kind), -1 if reverse else 1)
+            for kind, reverse in keys]
+        positions = range(len(summaries))
+        if len(ranks) == 1:
+            # Python's sort is stable even when reversed
+            perm = sorted(positions, key=ranks[0][0].__getitem__,
+                reverse=keys[0][1])
+        else:
+            perm = sorted(positions,
+                key=lambda pos: tuple(sign*r[pos] for r,sign in ranks))
+        if len(self.sortCache) >= self.MAX_SORTS:
+            self.sortCache.clear()
+        self.sortCache[keys] = (summaries, len(summaries), array.array('l', perm))
+        return self.sortCache[keys][2]
 
 #    FLAG_DELETED = 1
 #    FLAG_NEW = 2
@@ -174,6 +565,11 @@ class mailbox(object):
         once per second and at the conclusion."""
         self.state = mailbox.STATE_FINISHED
         return mailbox.STATE_FINISHED
+    def expunge(self, callback=None):
+        """Permanently remove the messages flagged as deleted. The
+        optional callback(mailbox, count, percent, status, msg) is
+        called once per second and at the conclusion."""
+        return mailbox.STATE_FINISHED
     def checkForUpdates(self):
         """Return NO_UPDATES, BOX_APPENDED, or BOX_CHANGED."""
         return NO_UPDATES
@@ -243,20 +639,319 @@ class mailbox(object):
             offset = ifile.tell()
             line = ifile.readline()
             if not line:
-                return hdrs
+                break
             line = line.rstrip()
             if not line or line.startswith("From "):
                 ifile.seek(offset)
-                return hdrs
+                break
             if line[0] in (' ','\t'):   # continuation
                 if key:
-                    hdrs[key] += u' ' + parseIso(line[1:])
+                    hdrs[key] += '\n' + line[1:]
             else:
                 line = line.split(':',1)
                 key = line[0]
-                value = line[1].strip() if len(line) > 1 else u''
-                hdrs[key] = parseIso(value)
+                hdrs[key] = line[1].strip() if len(line) > 1 else u''
+        # Decoded once all are read, since the sender is a hint to
+        # the charset of 8-bit text. Each line of a header is decoded
+        # separately.
+        sender = charsets.sender(hdrs["From"]) if "From" in hdrs else None
+        for key, value in hdrs.items():
+            if '\n' in value:
+                hdrs[key] = u' '.join([parseIso(line, sender)
+                    for line in value.split('\n')])
+            else:
+                hdrs[key] = parseIso(value, sender)
+        return hdrs
+
 
+def _indexAdd(index, key, pos):
+    """Add pos to the ascending list of positions index[key]."""
+    positions = index.get(key)
+    if positions is None:
+        index[key] = [pos]
+    elif positions[-1] < pos:
+        positions.append(pos)
+    else:
+        i = bisect.bisect_left(positions, pos)
+        if i == len(positions) or positions[i] != pos:
+            positions.insert(i, pos)
+
+def _indexDrop(index, key, pos):
+    positions = index.get(key)
+    if not positions:
+        return
+    i = bisect.bisect_left(positions, pos)
+    if i < len(positions) and positions[i] == pos:
+        del positions[i]
+        if not positions:
+            del index[key]
+
+
+class Fenwick(object):
+    """Binary indexed tree over a list of 0/1 values. Gives the number
+    of ones before any position, changes a value, and finds the k'th
+    one, each in O(log n), and appends a value in constant time."""
+    def __init__(self, values=()):
+        self.tree = array.array('l', [0])
+        self.total = 0
+        for value in values:
+            self.append(value)
+    def __len__(self):
+        return len(self.tree) - 1
+    def append(self, value):
+        # Node i holds the sum of the values from i - lowbit(i) + 1 to
+        # i, which is its own value plus nodes i-1, i-2, i-4, ... down
+        # to i - lowbit(i)/2. Amortized constant time.
+        tree = self.tree
+        i = len(tree)
+        self.total += value
+        step = 1
+        while step < i & -i:
+            value += tree[i - step]
+            step <<= 1
+        tree.append(value)
+    def add(self, pos, delta):
+        tree = self.tree
+        i = pos + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+        self.total += delta
+    def prefix(self, pos):
+        """Return the number of ones before pos."""
+        tree = self.tree
+        count = 0
+        while pos > 0:
+            count += tree[pos]
+            pos &= pos - 1
+        return count
+    def find(self, k):
+        """Return the position of the k'th one, counting from 1."""
+        tree = self.tree
+        pos = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            if pos + step < len(tree) and tree[pos+step] < k:
+                pos += step
+                k -= tree[pos]
+            step >>= 1
+        return pos
+
+
+class FlagIndex(object):
+    """The unread and the new messages of a view (a list of summaries
+    whose client fields are their rows), kept in Fenwick trees so that
+    the next or previous one from any row, and their counts, are found
+    in O(log n). Messages flagged deleted are neither. The index
+    follows flag changes by listening to the mailbox. Rows appended
+    to the view are added with append(), and rows deleted from it are
+    dropped with remove(); the trees are over slots, one per row ever
+    added, and a third tree maps rows to slots. Any other change to
+    the view needs a new index, as does a bulk change of the flags,
+    which marks the index stale."""
+    UNREAD = 1
+    NEW = 2
+    def __init__(self, box, view):
+        self.box = box
+        self.view = view
+        self.bits = bytearray()         # flags, by slot
+        self.slots = Fenwick()          # 1 for slots still in the view
+        self.trees = {self.UNREAD: Fenwick(), self.NEW: Fenwick()}
+        self.stale = False
+        self.append(view)
+        box.addListener(self.update)
+    def close(self):
+        self.box.removeListener(self.update)
+    @classmethod
+    def flagsOf(cls, summary):
+        status = summary.status
+        if status & messageSummary.FLAG_DELETED:
+            return 0
+        return (0 if status & messageSummary.FLAG_READ else cls.UNREAD) | \
+            (cls.NEW if status & messageSummary.FLAG_NEW else 0)
+    def __len__(self):
+        return self.slots.total
+    def _slot(self, row):
+        return self.slots.find(row + 1)
+    def _set(self, slot, flags):
+        old = self.bits[slot]
+        if old == flags:
+            return
+        self.bits[slot] = flags
+        for flag, tree in self.trees.items():
+            if (old ^ flags) & flag:
+                tree.add(slot, 1 if flags & flag else -1)
+    def append(self, summaries):
+        """Add rows for these summaries, which have been appended to
+        the view."""
+        trees = self.trees
+        for summary in summaries:
+            flags = self.flagsOf(summary)
+            self.bits.append(flags)
+            self.slots.append(1)
+            for flag, tree in trees.items():
+                tree.append(1 if flags & flag else 0)
+    def remove(self, row):
+        """Drop this row, which has been deleted from the view."""
+        slot = self._slot(row)
+        self._set(slot, 0)
+        self.slots.add(slot, -1)
+    def update(self, box, event, summary):
+        """Listener for flag changes."""
+        if event != "flags":
+            return
+        if summary is None:
+            self.stale = True
+            return
+        row = summary.client
+        if row is None or row >= len(self) or self.view[row] is not summary:
+            return
+        self._set(self._slot(row), self.flagsOf(summary))
+    def count(self, flag):
+        return self.trees[flag].total
+    def next(self, row, flag):
+        """Return the first row after this one with the flag, or None."""
+        tree = self.trees[flag]
+        k = tree.prefix(self._slot(row) + 1)
+        if k >= tree.total:
+            return None
+        return self.slots.prefix(tree.find(k + 1))
+    def previous(self, row, flag):
+        """Return the last row before this one with the flag, or None."""
+        tree = self.trees[flag]
+        k = tree.prefix(self._slot(row)) if row > 0 else 0
+        if k == 0:
+            return None
+        return self.slots.prefix(tree.find(k))
+
+
+if PY3:
+    def _wordBytes(words):
+        return words.tobytes()
+    def _setBytes(words, data):
+        words.frombytes(data)
+else:
+    def _wordBytes(words):
+        return words.tostring()
+    def _setBytes(words, data):
+        words.fromstring(data)
+
+# Matches up to the next 16-bit lane, four hex digits, which isn't zero
+_lane_re = re.compile(r"(?:0000)*(?!0000)([0-9a-f]{4})")
+
+def _matchTable(flags, value):
+    """Table for bytes.translate() which maps each byte b to 1 if
+    b & flags == value, else 0."""
+    return bytes(bytearray(1 if b & flags == value else 0 for b in range(256)))
+
+class FlagArray(object):
+    """The status flags of a mailbox's messages, by position, packed
+    one 16-bit word per message, and the flags each message had when
+    it was read, to tell which have been modified. The summaries of
+    the mailbox's messages read and set their status here. A single
+    message's flags are read and set in constant time. For bulk changes the array is taken as
+    one long integer, each message a 16-bit lane of it, so that
+    changing the flags of every message in a range or set is a few
+    operations on the integer, whatever the number of messages. The
+    lanes which differ afterwards are the messages which changed.
+    Counts are popcounts of the lanes which match."""
+    def __init__(self, statuses=(), original=None):
+        self.words = array.array('H', statuses)
+        self.original = array.array('H',
+            self.words if original is None else original)
+    def __len__(self):
+        return len(self.words)
+    def __getitem__(self, pos):
+        return self.words[pos]
+    def __setitem__(self, pos, status):
+        self.words[pos] = status
+    def append(self, status, original=None):
+        self.words.append(status)
+        self.original.append(status if original is None else original)
+    def modified(self, pos):
+        return self.words[pos] != self.original[pos]
+    @staticmethod
+    def _toInt(words):
+        return int(binascii.hexlify(_wordBytes(words)) or b"0", 16)
+    def _fromInt(self, value):
+        words = array.array('H')
+        _setBytes(words, binascii.unhexlify("%0*x" % (4*len(self.words), value)))
+        return words
+    def _lanes(self, value):
+        """Return value repeated in every lane."""
+        return self._toInt(array.array('H', [value]) * len(self.words))
+    def rangeMask(self, start, end):
+        """Return the mask which selects positions start up to end."""
+        n = len(self.words)
+        start = max(start, 0)
+        end = min(end, n)
+        if start >= end:
+            return 0
+        # The first position is the most significant lane
+        return ((1 << 16*(end - start)) - 1) << 16*(n - end)
+    def mask(self, positions):
+        """Return the mask which selects these positions."""
+        mask = array.array('H', [0]) * len(self.words)
+        for pos in positions:
+            mask[pos] = 0xffff
+        return self._toInt(mask)
+    def change(self, mask, toSet, toClear, toToggle=0):
+        """Change the flags of the messages selected by mask. Returns
+        the difference, for nChanged() and positions()."""
+        if not mask:
+            return ""
+        old = self._toInt(self.words)
+        new = old
+        if toSet:
+            new |= mask & self._lanes(toSet)
+        if toClear:
+            new &= ~(mask & self._lanes(toClear))
+        if toToggle:
+            new ^= mask & self._lanes(toToggle)
+        if new == old:
+            return ""
+        self.words = self._fromInt(new)
+        # With the trailing zero lanes gone every match is a lane
+        # which changed
+        diff = ("%0*x" % (4*len(self.words), old ^ new)).rstrip("0")
+        return diff + "0" * (-len(diff) % 4)
+    @staticmethod
+    def nChanged(diff):
+        """Return the number of messages whose flags changed."""
+        return len(_lane_re.findall(diff))
+    @staticmethod
+    def positions(diff):
+        """Return the positions of the messages whose flags changed,
+        in order."""
+        return [m.start(1) >> 2 for m in _lane_re.finditer(diff)]
+    def _matches(self, flags, value):
+        """Return a byte string with a 1 for each message whose status
+        & flags == value, else 0."""
+        data = _wordBytes(self.words)
+        lo, hi = data[0::2], data[1::2]
+        if sys.byteorder != "little":
+            lo, hi = hi, lo
+        lo = lo.translate(_matchTable(flags & 0xff, value & 0xff))
+        if not flags >> 8 or not lo:
+            return lo
+        hi = hi.translate(_matchTable(flags >> 8, value >> 8))
+        both = int(binascii.hexlify(lo), 16) & int(binascii.hexlify(hi), 16)
+        return binascii.unhexlify("%0*x" % (2*len(lo), both))
+    def count(self, flags, value=None):
+        """Return the number of messages with all these flags set, or
+        if value is given, whose status & flags == value."""
+        if value is None:
+            value = flags
+        return self._matches(flags, value).count(b"\x01")
+    def matching(self, flags, value=None):
+        """Generate the positions of the messages counted by count()."""
+        if value is None:
+            value = flags
+        data = self._matches(flags, value)
+        pos = data.find(b"\x01")
+        while pos >= 0:
+            yield pos
+            pos = data.find(b"\x01", pos + 1)
 
 
 class messageSummary(object):
@@ -276,16 +971,26 @@ class messageSummary(object):
     FLAG_CC = 0x40
     FLAG_SELECTED = 0x80
     FLAG_FLAGGED = 0x100
+    # Once the message is in a mailbox, its status is kept in the
+    # mailbox's FlagArray, at position idx, and whether it has been
+    # modified is worked out from there; until then, here.
+    flagArray = None
+    _status = 0
+    _modified = False
     def __init__(self):
         self.offset = 0
         self.size = 0
         self.From = None
         self.To = None
+        self.Cc = None
         self.Subject = None
         self.Date = None
         self.udate = None       # Unix time
         self.status = 0
         self.MessageId = None
+        self.InReplyTo = None
+        self.References = None
+        self.digest = None      # Of the body, see dedupe.py
         self.uid = None
         self.key = None
         self.idx = None         # Counting from 0
@@ -295,8 +1000,61 @@ class messageSummary(object):
         # module uses it to track the message's position in
         # the filtered view of the summaries.
         self.client = None
+    # Fields exported by toDict()
+    FIELDS = ("offset", "size", "From", "To", "Cc", "Subject", "Date", "udate",
+        "status", "MessageId", "InReplyTo", "References", "uid", "key")
     def __repr__(self):
         return "<MboxMessage %s \"%s\">" % (self.client, self.Subject)
+    @property
+    def status(self):
+        flags = self.flagArray
+        return self._status if flags is None else flags.words[self.idx]
+    @status.setter
+    def status(self, status):
+        flags = self.flagArray
+        if flags is None:
+            self._status = status
+        else:
+            flags.words[self.idx] = status
+    @property
+    def modified(self):
+        """True if the flags have been changed since the message was
+        read."""
+        flags = self.flagArray
+        return self._modified if flags is None else flags.modified(self.idx)
+    @modified.setter
+    def modified(self, modified):
+        flags = self.flagArray
+        if flags is None:
+            self._modified = modified
+        elif not modified:
+            flags.original[self.idx] = flags.words[self.idx]
+    @property
+    def originalStatus(self):
+        """The flags the message had when it was read."""
+        flags = self.flagArray
+        return self._status if flags is None else flags.original[self.idx]
+    def __getstate__(self):
+        # The client field belongs to whoever is viewing the mailbox
+        # right now, so it is not persisted. Nor is the mailbox's flag
+        # array, so a copy has its own status.
+        state = self.__dict__.copy()
+        state["client"] = None
+        state.pop("flagArray", None)
+        state["_status"] = self.status
+        state["_modified"] = self.modified
+        return state
+    def toDict(self):
+        """Return the summary data as a dict, e.g. for export."""
+        return dict((f, getattr(self, f)) for f in self.FIELDS)
+    @classmethod
+    def fromDict(cls, d):
+        """Inverse of toDict()."""
+        msg = cls()
+        for f in cls.FIELDS:
+            if f in d:
+                setattr(msg, f, d[f])
+        return msg
     def getValues(self):
         """Return a (status, subject, from, date, size) tuple."""
         # Fit the status into three letters
@@ -313,14 +1071,16 @@ class messageSummary(object):
         date = time.strftime("%Y-%m-%d %H:%M", time.localtime(self.udate))
         return (status, self.Subject, self.From, date,
             human_readable(self.size))
+    def setAddressFlags(self):
+        """Set FLAG_DIRECT or FLAG_CC if the message is addressed to
+        the user; see setMyAddresses()."""
+        self.status = self.status & ~(self.FLAG_DIRECT|self.FLAG_CC) | \
+            addressFlags(self.To, self.Cc)
+        return self
     def parseDate(self):
-        st = email.utils.parsedate_tz(self.Date)
-        if st is None:
+        self.udate = dates.parseDate(self.Date)
+        if self.udate is None:
             self.udate = 0    # TODO: is there a better choice?
-        else:
-            self.udate = time.mktime(st[:9])
-            if st[9]:
-                self.udate += st[9]
         return self
 
     def getMessage(self, mbox):
@@ -328,9 +1088,131 @@ class messageSummary(object):
         return None
 
 
+reply_re = re.compile(r"^(\s*(re|fwd?|aw|sv)\s*(\[\d+\])?\s*:)+", re.I)
+
+def normalizeSubject(subject):
+    """Return the subject with any Re: or Fwd: prefixes removed,
+    whitespace collapsed, and case folded, for grouping messages
+    by subject."""
+    if not subject:
+        return u""
+    return u" ".join(reply_re.sub(u"", subject).split()).lower()
+
+def normalizeAddress(value):
+    """Return the bare, lower-case email address from a From or
+    similar header, or u"" if there isn't one."""
+    if not value:
+        return u""
+    addr = email.utils.parseaddr(value)[1]
+    return (addr or value.strip()).lower()
+
+class Memo(object):
+    """A bounded table of remembered results, which counts its hits
+    so that the size can be tuned. When full, it is emptied."""
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.data = {}
+        self.hits = self.lookups = 0
+    def get(self, key):
+        self.lookups += 1
+        value = self.data.get(key)
+        if value is not None:
+            self.hits += 1
+        return value
+    def put(self, key, value):
+        if len(self.data) >= self.size:
+            self.data.clear()
+        self.data[key] = value
+        return value
+    def __str__(self):
+        return "%s %d lookups, %.0f%% hits, %d entries" % (self.name,
+            self.lookups, 100. * self.hits / max(self.lookups, 1),
+            len(self.data))
+
+# The same header values turn up over and over in a large mailbox
+# (a newsletter, a mailing list, a regular correspondent), so their
+# parsed forms are remembered by the raw value.
+addressCache = Memo("addresses", 20000)
+decodeCache = Memo("decoded", 10000)
+internTable = Memo("interned", 100000)
+
+def memoReport():
+    """Return the hit rates of the header memos, for the log."""
+    return "; ".join(str(m) for m in (decodeCache, internTable, addressCache))
+
+def internValue(value):
+    """Return the one copy kept of this header value, so that
+    summaries with the same sender, say, share one string."""
+    if not value:
+        return value
+    shared = internTable.get(value)
+    if shared is None:
+        shared = internTable.put(value, value)
+    return shared
+
+def addressList(value):
+    """Return the bare, lower-case email addresses from a To, Cc,
+    or similar header, as a tuple."""
+    if not value:
+        return ()
+    addrs = addressCache.get(value)
+    if addrs is None:
+        addrs = addressCache.put(value, tuple(addr.lower()
+            for name, addr in email.utils.getaddresses([value]) if addr))
+    return addrs
+
+# The user's own addresses; see setMyAddresses()
+_myAddresses = frozenset()
+_myPattern = None
+_myKey = u""
+
+def setMyAddresses(addresses):
+    """Set the user's own email addresses, by which messages are
+    flagged FLAG_DIRECT or FLAG_CC as they are scanned. Each is an
+    address, or a pattern with '*' wildcards such as "*@example.com".
+    Case doesn't matter."""
+    global _myAddresses, _myPattern, _myKey
+    addresses = sorted(set(a.strip().lower() for a in addresses if a.strip()))
+    _myAddresses = frozenset(a for a in addresses if '*' not in a)
+    patterns = [re.escape(a).replace(r"\*", ".*")
+        for a in addresses if '*' in a]
+    _myPattern = re.compile(r"(?:%s)\Z" % "|".join(patterns)) \
+        if patterns else None
+    _myKey = u",".join(addresses)
+
+def myAddresses():
+    """Return the user's addresses as one string, to tell whether
+    they have changed."""
+    return _myKey
+
+def addressFlags(to, cc):
+    """Return FLAG_DIRECT if one of the user's addresses is in the
+    To header to, else FLAG_CC if one is in the Cc header cc, else 0."""
+    for header, flag in ((to, messageSummary.FLAG_DIRECT),
+                         (cc, messageSummary.FLAG_CC)):
+        for addr in addressList(header):
+            if addr in _myAddresses or \
+                    (_myPattern is not None and _myPattern.match(addr)):
+                return flag
+    return 0
+
+
+def parseIso(s, sender=None):
+    """Accept ascii text, parse per RFC 2047, return unicode. The
+    decoding of encoded text is remembered in decodeCache. sender,
+    the sender's address, helps guess the charset of 8-bit text."""
+    if "=?" not in s:
+        return _decodeIso(s, sender)
+    # How 8-bit text is decoded depends on the sender
+    key = s if charsets.isAscii(s) else (s, sender)
+    value = decodeCache.get(key)
+    if value is None:
+        value = decodeCache.put(key, _decodeIso(s, sender))
+    return value
+
 if PY3:
-    def parseIso(s):
-        """Accept ascii text, parse per RFC 2047, return unicode."""
+    def _decodeIso(s, sender=None):
         if "=?" not in s: return s
         parts = email.header.decode_header(s)
         rval = []
@@ -346,18 +1228,18 @@ if PY3:
 
 else:
     iso_re = re.compile(r"""(=\?.+?\?.+?\?.+?\?=)""")
-    def parseIso(s):
+    def _decodeIso(s, sender=None):
         """Bug in the python 2 parser, we'll need to split the
         string first."""
         # To be precise, the Python 2.7 decode_header() function fails
         # with "=?UTF-8?B?VFJFTkQgTE9BTiBDT01QQU5Z?=<notification@teemi.my>"
-        if "=?" not in s: return toU(s)
+        if "=?" not in s: return toU(s, sender)
         rval = []
         parts = iso_re.split(s)
         for part in parts:
             if part:
                 if "=?" not in part:
-                    rval.append(toU(part))
+                    rval.append(toU(part, sender))
                 else:
                     parts2 = email.header.decode_header(part)
                     for part2 in parts2:
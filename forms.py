@@ -1079,6 +1079,9 @@ class Form(object):
             wid = wid // ncol
             self.cwidths = [(i*wid,wid-1) for i in range(ncol)]
             return self
+        def itemValues(self, item):
+            """Return the column values to display for this item."""
+            return item.getValues()
         def displayContent(self, line0=0, line1=None):
             """Display the options"""
             if self.contentLen <= 0: return self
@@ -1101,7 +1104,7 @@ class Form(object):
                     win.attrset(curses.A_BOLD)
                 win.addstr(i,0, '>' if i+scroll == current else ' ')
                 win.addstr(i,1, optKeys[i])
-                values = items[i+scroll].getValues()
+                values = self.itemValues(items[i+scroll])
                 win.move(i, 3)
                 win.clrtoeol()
                 for j,s in enumerate(values):
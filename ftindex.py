@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Full-text search index for a mailbox.
+
+The index maps each token of a message's Subject, From, To, Cc and
+decoded text parts to the list of messages containing it. Tokens from
+the headers are also indexed with "subject:", "from:", "to:" and
+"cc:" prefixes so that queries can be limited to those fields.
+Messages are identified by their ordinal position in the mailbox
+file, which doesn't change as mail is appended; the index is rebuilt
+if the mailbox is otherwise modified, which is found by comparing the
+file offset of every message indexed.
+
+The index is saved in two parts: the base, and a segment holding
+only the postings of messages indexed since. Indexing new mail
+rewrites just the segment; once that has grown to MERGE_FRACTION of
+the base, the two are merged and saved as a new base.
+
+Query syntax: whitespace-separated terms, all of which must match.
+A term is a word, a "quoted phrase", or either of those prefixed
+with from:, to:, cc: or subject:. Phrases are found by intersecting the
+postings of their words and then checking the candidates."""
+
+from __future__ import print_function
+
+import array
+import bisect
+import re
+import sys
+import time
+
+import cache
+from utils import writeLog
+
+PY3 = sys.version_info[0] >= 3
+if PY3:
+    unicode = str
+
+FIELDS = ("from", "to", "cc", "subject")
+MINTOKEN = 2
+MAXTOKEN = 32
+MERGE_FRACTION = 0.25   # segment size, relative to the base, to merge at
+
+token_re = re.compile(r"\w+", re.UNICODE)
+tag_re = re.compile(r"<[^>]*>")
+query_re = re.compile(r'(?:(\w+):)?(?:"([^"]*)"|(\S+))', re.UNICODE)
+
+def tokenize(s):
+    """Return the list of index tokens in this string."""
+    if not s:
+        return []
+    return [t for t in token_re.findall(s.lower())
+        if MINTOKEN <= len(t) <= MAXTOKEN]
+
+def textParts(msg):
+    """Generate the decoded text of each text/plain or text/html part
+    of an email.message object, as unicode. Markup is stripped."""
+    for part in msg.walk():
+        if part.is_multipart():
+            continue
+        ctype = part.get_content_type()
+        if ctype not in ("text/plain", "text/html"):
+            continue
+        text = part.get_payload(decode=True)
+        if not text:
+            continue
+        if not isinstance(text, unicode):
+            try:
+                text = text.decode(part.get_content_charset() or "latin-1",
+                    "replace")
+            except LookupError:
+                text = text.decode("latin-1")
+        if ctype == "text/html":
+            text = tag_re.sub(u" ", text)
+        yield text
+
+def normalize(s):
+    """Collapse case and punctuation, for phrase matching."""
+    return u" ".join(tokenize(s))
+
+
+class FullTextIndex(object):
+    """Inverted index over one mailbox. Use get() to obtain the
+    index for a mailbox rather than creating one directly."""
+    def __init__(self, mbox):
+        self.mbox = mbox
+        self.reset()
+
+    def reset(self):
+        self.postings = {}                  # token => array of ordinals
+        self.offsets = array.array('l')     # ordinal => file offset
+        self.base = 0                       # ordinals saved in the base
+        self.segment = {}                   # postings of the others
+        self.checked = (None, 0)            # summaries, count valid()
+
+    def load(self):
+        """Load the index from the cache. Return True on success."""
+        data = cache.load(self.mbox.path, "ftindex")
+        if not data or data.get("fields") != FIELDS:
+            return False
+        self.reset()
+        self.postings = data["postings"]
+        self.offsets = data["offsets"]
+        self.base = len(self.offsets)
+        self.segment = {}
+        segment = cache.load(self.mbox.path, "ftsegment")
+        if segment and segment["base"] == self.base:
+            postings = self.postings
+            for token, plist in segment["postings"].items():
+                if token in postings:
+                    postings[token].extend(plist)
+                else:
+                    postings[token] = array.array('I', plist)
+            self.segment = segment["postings"]
+            self.offsets.extend(segment["offsets"])
+        return True
+
+    def save(self):
+        """Save the segment, or if it has grown large enough, the
+        whole index as the new base."""
+        path = self.mbox.path
+        n = len(self.offsets)
+        if not self.base or n - self.base > self.base * MERGE_FRACTION:
+            if not cache.save(path,
+                    {"postings": self.postings, "offsets": self.offsets,
+                     "fields": FIELDS}, "ftindex"):
+                return False
+            cache.remove(path, "ftsegment")
+            self.base = n
+            self.segment = {}
+            return True
+        return cache.save(path, {"base": self.base,
+            "postings": self.segment, "offsets": self.offsets[self.base:]},
+            "ftsegment")
+
+    def valid(self):
+        """True if everything indexed is still in the mailbox where
+        we found it. The offsets are compared once for each summary
+        list the mailbox has; it makes a new one when the file has
+        been rewritten."""
+        summaries = self.mbox.summaries() or []
+        n = len(self.offsets)
+        if n > len(summaries):
+            return False
+        if self.checked[0] is summaries and self.checked[1] >= n:
+            return True
+        if array.array('l', [s.offset for s in summaries[:n]]) != self.offsets:
+            return False
+        self.checked = (summaries, n)
+        return True
+
+    def nindexed(self):
+        return len(self.offsets)
+
+    def update(self, callback=None):
+        """Index any messages in the mailbox that haven't been indexed
+        yet. The optional callback(mbox, count, pct, status, msg) is
+        called every 0.5 seconds or so, and at the conclusion. Returns
+        the mailbox state constant, as with getOverview()."""
+        mbox = self.mbox
+        if not self.valid():
+            writeLog("Rebuilding search index for %s" % mbox.name)
+            self.reset()
+        summaries = mbox.summaries() or []
+        start = lastcb = time.time()
+        first = len(self.offsets)
+        status = mbox.STATE_FINISHED
+        try:
+            with open(mbox.path, "r") as ifile:
+                for i in range(first, len(summaries)):
+                    self.add(i, summaries[i], ifile)
+                    now = time.time()
+                    if callback and now > lastcb + 0.5:
+                        lastcb = now
+                        callback(mbox, i, 100.*i/len(summaries),
+                            mbox.STATE_READING, None)
+        except KeyboardInterrupt:
+            status = mbox.STATE_INTERRUPTED
+        count = len(self.offsets) - first
+        self.checked = (summaries, len(self.offsets))
+        if count:
+            self.save()
+        elapsed = max(time.time() - start, 1e-6)
+        report = "Indexed %d messages in %.2fs, %.0f/s" % \
+            (count, elapsed, count/elapsed)
+        writeLog("%s: %s" % (mbox.name, report))
+        if callback:
+            callback(mbox, len(self.offsets), 100., status,
+                "Interrupted by user" if status != mbox.STATE_FINISHED else
+                report if count else None)
+        return status
+
+    def add(self, ordinal, summary, ifile):
+        """Index one message, reading it from ifile."""
+        tokens = set()
+        for field in FIELDS:
+            words = tokenize(getattr(summary, field.capitalize()))
+            tokens.update(words)
+            tokens.update(field + ":" + t for t in words)
+        ifile.seek(summary.offset)
+        msg = self.mbox.parser.parsestr(ifile.read(summary.size))
+        for text in textParts(msg):
+            tokens.update(tokenize(text))
+        postings = self.postings
+        segment = self.segment
+        for token in tokens:
+            plist = postings.get(token)
+            if plist is None:
+                postings[token] = plist = array.array('I')
+            plist.append(ordinal)
+            plist = segment.get(token)
+            if plist is None:
+                segment[token] = plist = array.array('I')
+            plist.append(ordinal)
+        self.offsets.append(summary.offset)
+
+    def search(self, query):
+        """Return the list of summaries matching this query, in
+        mailbox order. Raises ValueError if the query has no words
+        long enough to be indexed."""
+        summaries = self.mbox.summaries()
+        terms = parseQuery(query)
+        if not terms:
+            raise ValueError("Search words must be at least %d letters long"
+                % MINTOKEN)
+        if not summaries or not self.valid():
+            return []
+        lists = []
+        phrases = []
+        for field, words, phrase in terms:
+            prefix = field + ":" if field else ""
+            for word in words:
+                lists.append(self.postings.get(prefix + word, ()))
+            if phrase:
+                phrases.append((field, phrase))
+        lists.sort(key=len)
+        hits = []
+        for ordinal in lists[0]:
+            for plist in lists[1:]:
+                i = bisect.bisect_left(plist, ordinal)
+                if i >= len(plist) or plist[i] != ordinal:
+                    break
+            else:
+                hits.append(ordinal)
+        hits = [summaries[i] for i in hits]
+        if phrases:
+            with open(self.mbox.path, "r") as ifile:
+                for field, phrase in phrases:
+                    hits = [s for s in hits
+                        if self._hasPhrase(s, field, phrase, ifile)]
+        return hits
+
+    def _hasPhrase(self, summary, field, phrase, ifile):
+        if field:
+            return phrase in normalize(getattr(summary, field.capitalize()))
+        for field in FIELDS:
+            if phrase in normalize(getattr(summary, field.capitalize())):
+                return True
+        ifile.seek(summary.offset)
+        msg = self.mbox.parser.parsestr(ifile.read(summary.size))
+        for text in textParts(msg):
+            if phrase in normalize(text):
+                return True
+        return False
+
+
+def parseQuery(query):
+    """Parse a query into a list of (field, words, phrase) tuples;
+    field is None or one of FIELDS, phrase is None for single words."""
+    if not isinstance(query, unicode):
+        query = query.decode("utf8", "replace")
+    terms = []
+    for mo in query_re.finditer(query):
+        field = mo.group(1)
+        if field:
+            field = field.lower()
+            if field not in FIELDS:
+                # Not a field after all; treat the whole thing as text
+                field = None
+                text = mo.group(0).replace(u'"', u' ')
+            else:
+                text = mo.group(2) if mo.group(2) is not None else mo.group(3)
+        else:
+            text = mo.group(2) if mo.group(2) is not None else mo.group(3)
+        words = tokenize(text)
+        if not words:
+            continue
+        phrase = u" ".join(words) if len(words) > 1 else None
+        terms.append((field, words, phrase))
+    return terms
+
+def get(mbox):
+    """Return the search index for this mailbox, loading it from
+    the cache the first time."""
+    index = getattr(mbox, "_ftindex", None)
+    if index is None:
+        index = FullTextIndex(mbox)
+        index.load()
+        mbox._ftindex = index
+    return index
+
+def loaded(mbox):
+    """Return the search index for this mailbox if it is already in
+    memory, else None."""
+    return getattr(mbox, "_ftindex", None)
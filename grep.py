@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Brute-force regular expression search of the message text of
+every mailbox in an account, with no index. The mailbox files are
+cut into chunks which are farmed out to a pool of processes, so the
+search runs on every core. Each worker maps its file into memory,
+walks the messages in its chunk, and matches the expression against
+the lines of each message's decoded text parts. Matches are sent
+back as they are found, one per message (the first matching line).
+
+Messages that are plain ASCII with no encoded or html parts are
+first checked with a bytes version of the expression against the
+raw message, which rejects most of them without parsing."""
+
+from __future__ import print_function
+
+import email.parser
+import mmap
+import multiprocessing
+import os
+import re
+import signal
+import sys
+import time
+
+import ftindex
+from emailaccount import mailbox
+from utils import writeLog
+
+PY3 = sys.version_info[0] >= 3
+if PY3:
+    import queue as Queue
+    unicode = str
+else:
+    import Queue
+
+CHUNK = 32 << 20        # bytes of mailbox per job
+MAXLINE = 200           # characters of matching line to keep
+
+FROM_SEP = b"\nFrom "
+nonascii_re = re.compile(b"[\r\x80-\xff]")
+complex_re = re.compile(
+    br"(?i)^content-(?:transfer-encoding:\s*(?:base64|quoted-printable)|"
+    br"type:\s*text/html)", re.M)
+
+
+class Hit(object):
+    """One matching message: its mailbox, offset, and the matching
+    line."""
+    def __init__(self, box, offset, line):
+        self.box = box
+        self.offset = offset
+        self.line = line
+    def getValues(self):
+        return (self.box.name, self.line)
+    def __str__(self):
+        return "%s: %s" % (self.box.name, self.line)
+
+
+class Grep(object):
+    """Search the given mailboxes for a regular expression. Call
+    run() to do the search; matches accumulate in self.hits."""
+    def __init__(self, boxes, pattern, ignoreCase=True, processes=None):
+        if not isinstance(pattern, unicode):
+            pattern = pattern.decode("utf8")
+        self.boxes = dict((os.path.abspath(box.path), box) for box in boxes)
+        self.pattern = pattern
+        self.flags = re.IGNORECASE if ignoreCase else 0
+        self.processes = processes or multiprocessing.cpu_count()
+        self.hits = []
+        self.nbytes = 0
+
+    def jobs(self):
+        """Cut the mailboxes into chunks, largest mailboxes first so
+        that the stragglers at the end are small."""
+        jobs = []
+        for path in sorted(self.boxes, key=lambda p: -_size(p)):
+            size = _size(path)
+            for start in range(0, size, CHUNK):
+                jobs.append((path, start, min(start+CHUNK, size),
+                    self.pattern, self.flags))
+        return jobs
+
+    def run(self, callback=None):
+        """Search. The optional callback(grep, count, pct, status, msg)
+        is called every 0.5 seconds or so while there are new matches
+        or progress to report, and at the conclusion. Returns one of
+        the mailbox STATE_ constants. ^C stops the search; the matches
+        found so far are kept."""
+        re.compile(self.pattern, self.flags)    # Let caller see errors
+        jobs = self.jobs()
+        total = sum(job[2] - job[1] for job in jobs) or 1
+        results = multiprocessing.Queue()
+        pool = multiprocessing.Pool(min(self.processes, len(jobs) or 1),
+            _initWorker, (results,))
+        start = lastcb = time.time()
+        status = mailbox.STATE_FINISHED
+        done = 0
+        try:
+            result = pool.map_async(_grepRange, jobs)
+            while done < len(jobs):
+                try:
+                    path, offset, data = results.get(timeout=0.2)
+                except Queue.Empty:
+                    if result.ready() and not result.successful():
+                        result.get()     # Raises the worker's exception
+                    continue
+                if offset is None:
+                    done += 1
+                    self.nbytes += data
+                else:
+                    self.hits.append(Hit(self.boxes[path], offset, data))
+                now = time.time()
+                if callback and now > lastcb + 0.5:
+                    lastcb = now
+                    callback(self, len(self.hits), 100.*self.nbytes/total,
+                        mailbox.STATE_READING, None)
+            pool.close()
+        except KeyboardInterrupt:
+            status = mailbox.STATE_INTERRUPTED
+            pool.terminate()
+        except Exception as e:
+            writeLog("grep %s failed: %s" % (self.pattern, e))
+            status = mailbox.STATE_INTERRUPTED
+            pool.terminate()
+        pool.join()
+        self.hits.sort(key=lambda h: (h.box.name, h.offset))
+        elapsed = max(time.time() - start, 1e-6)
+        report = "%d matches in %.1fs, %.1f MB/s on %d processes" % \
+            (len(self.hits), elapsed, self.nbytes/elapsed/(1<<20), self.processes)
+        writeLog("grep %s: %s" % (self.pattern, report))
+        if callback:
+            callback(self, len(self.hits), 100.*self.nbytes/total, status,
+                "Interrupted by user" if status != mailbox.STATE_FINISHED
+                else report)
+        return status
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+# Below this point runs in the worker processes
+
+_results = None
+
+def _initWorker(results):
+    global _results
+    _results = results
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # Parent handles ^C
+
+def _grepRange(job):
+    """Search the messages which start within [start,end) of a
+    mailbox file, posting (path, offset, line) for each match and
+    (path, None, nbytes) when done."""
+    path, start, end, pattern, flags = job
+    uregex = re.compile(pattern, flags | re.UNICODE)
+    try:
+        bregex = re.compile(pattern.encode("ascii"), flags | re.M)
+    except (re.error, UnicodeError):
+        bregex = None
+    parser = email.parser.BytesParser() if PY3 else email.parser.Parser()
+    try:
+        with open(path, "rb") as ifile:
+            mm = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                _grepMap(mm, path, start, end, uregex, bregex, parser)
+            finally:
+                mm.close()
+    except (IOError, OSError, ValueError) as e:
+        writeLog("grep: failed to read %s: %s" % (path, e))
+    finally:
+        _results.put((path, None, end - start))
+
+def _grepMap(mm, path, start, end, uregex, bregex, parser):
+    size = len(mm)
+    end = min(end, size)
+    if start > 0:
+        start = mm.find(FROM_SEP, start-1)
+        if start < 0:
+            return
+        start += 1
+    while start < end:
+        nxt = mm.find(FROM_SEP, start)
+        nxt = size if nxt < 0 else nxt + 1
+        raw = mm[start:nxt]
+        if bregex is None or nonascii_re.search(raw) or \
+                complex_re.search(raw) or bregex.search(raw):
+            line = _grepMessage(raw, uregex, parser)
+            if line is not None:
+                _results.put((path, start, line))
+        start = nxt
+
+def _grepMessage(raw, regex, parser):
+    """Return the first line of the message text matching regex,
+    or None."""
+    msg = parser.parsebytes(raw) if PY3 else parser.parsestr(raw)
+    for text in ftindex.textParts(msg):
+        for line in text.splitlines():
+            if regex.search(line):
+                return line.strip()[:MAXLINE]
+    return None
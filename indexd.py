@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Background indexer. One daemon per user keeps the summaries
+of the user's system mailbox and mail folders up to date, and serves
+them to any number of trm sessions over a Unix-domain socket, so
+that each session need not scan every mailbox itself.
+
+Start it with "trm --indexd". Sessions find it through the socket in
+the cache directory; if it isn't running, they simply scan the
+mailboxes themselves.
+
+The protocol is one JSON object per line in each direction:
+
+  {"op":"stat", "path":P}
+      => {"ok":true, "count":n, "size":s, "firstOffset":o, "firstFrom":l,
+          "lastOffset":o, "lastFrom":l}
+  {"op":"summaries", "path":P, "start":i, "count":n}
+      => {"ok":true, "summaries":[{...}, ...]}
+
+Anything else, or a mailbox the daemon isn't ready to serve,
+yields {"ok":false, "error":msg}. Unknown mailboxes are added to the
+watch list."""
+
+from __future__ import print_function
+
+import errno
+import json
+import os
+import select
+import socket
+import sys
+import time
+
+import cache
+import mbox
+from utils import writeLog
+
+PY3 = sys.version_info[0] >= 3
+
+POLL_INTERVAL = 2.0     # seconds between checks for new mail
+RESCAN_INTERVAL = 60.0  # seconds between checks for new folders
+PAGE_SIZE = 2000        # summaries per request, used by clients
+RETRY_INTERVAL = 30.0   # seconds before a client tries a dead daemon again
+REPLY_TIMEOUT = 2.0     # seconds a client waits for a reply before scanning
+
+def socketPath():
+    return os.path.join(cache.cacheDir(), "indexd.sock")
+
+
+class Server(object):
+    """Watches the mailboxes of an account and answers requests."""
+    def __init__(self, account, boxes):
+        mbox.Mbox.useIndexer = False    # That would be us
+        self.account = account
+        self.boxes = dict((os.path.abspath(box.path), box) for box in boxes)
+        self.clients = {}       # socket => input buffer
+        self.listener = None
+        self.lastRescan = time.time()
+
+    def serve(self):
+        """Run until interrupted."""
+        path = socketPath()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        os.chmod(path, 0o600)
+        self.listener.listen(16)
+        writeLog("indexd listening on %s, %d mailboxes" % (path, len(self.boxes)))
+        try:
+            while True:
+                self.update()
+                self.poll(POLL_INTERVAL)
+        finally:
+            self.listener.close()
+            for sock in list(self.clients):
+                sock.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def update(self):
+        """Bring every mailbox up to date."""
+        now = time.time()
+        if self.account and now > self.lastRescan + RESCAN_INTERVAL:
+            self.lastRescan = now
+            for box in self.account.getMboxes():
+                path = os.path.abspath(box.path)
+                if path not in self.boxes:
+                    self.boxes[path] = box
+        for box in list(self.boxes.values()):
+            try:
+                if box.state == box.STATE_FINISHED and \
+                        box.checkForUpdates() == box.NO_UPDATES:
+                    continue
+                if not os.path.isfile(box.path):
+                    del self.boxes[os.path.abspath(box.path)]
+                    continue
+                box.getOverview(self.progress)
+            except Exception as e:
+                writeLog("indexd: failed to scan %s: %s" % (box.path, e))
+
+    def progress(self, box, count, pct, status, msg):
+        """getOverview() callback; keep answering while we scan."""
+        if msg:
+            writeLog("indexd: %s: %s" % (box.name, msg))
+        self.poll(0)
+
+    def poll(self, timeout):
+        """Accept connections and answer requests for up to timeout
+        seconds."""
+        socks = [self.listener] + list(self.clients)
+        try:
+            ready = select.select(socks, [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for sock in ready:
+            if sock is self.listener:
+                conn = self.listener.accept()[0]
+                self.clients[conn] = b""
+                continue
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                data = b""
+            if not data:
+                del self.clients[sock]
+                sock.close()
+                continue
+            buf = self.clients[sock] + data
+            while b"\n" in buf:
+                line, buf = buf.split(b"\n", 1)
+                try:
+                    reply = self.handle(json.loads(line.decode("utf8")))
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                try:
+                    sock.sendall(json.dumps(reply).encode("utf8") + b"\n")
+                except socket.error:
+                    buf = b""
+                    break
+            self.clients[sock] = buf
+
+    def handle(self, req):
+        op = req.get("op")
+        path = req.get("path")
+        box = self.boxes.get(path)
+        if box is None:
+            if op in ("stat", "summaries") and path and os.path.isfile(path):
+                self.boxes[path] = mbox.Mbox(os.path.basename(path), path)
+            return {"ok": False, "error": "not indexed yet"}
+        summaries = box.summaries()
+        if box.updates == box.BOX_CHANGED or not summaries:
+            return {"ok": False, "error": "not indexed yet"}
+        if op == "stat":
+            return {"ok": True, "count": len(summaries),
+                "size": box.scannedSize(),
+                "firstOffset": summaries[0].offset, "firstFrom": box.firstFrom(),
+                "lastOffset": summaries[-1].offset, "lastFrom": box.lastFrom}
+        if op == "summaries":
+            start = int(req.get("start", 0))
+            count = int(req.get("count", PAGE_SIZE))
+            return {"ok": True, "summaries":
+                [msg.toDict() for msg in summaries[start:start+count]]}
+        return {"ok": False, "error": "unknown request %s" % op}
+
+
+class Client(object):
+    """Connection to the indexer daemon."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b""
+    def request(self, **req):
+        """Send one request, return the reply or None on failure. If
+        the daemon is too busy to answer within REPLY_TIMEOUT, the
+        connection is dropped, and the caller scans the mailbox
+        itself."""
+        try:
+            self.sock.sendall(json.dumps(req).encode("utf8") + b"\n")
+            while b"\n" not in self.buf:
+                data = self.sock.recv(1 << 20)
+                if not data:
+                    raise socket.error("indexd closed the connection")
+                self.buf += data
+        except socket.timeout:
+            writeLog("indexd request timed out")
+            _dropClient()
+            return None
+        except socket.error as e:
+            writeLog("indexd request failed: %s" % e)
+            _dropClient()
+            return None
+        line, self.buf = self.buf.split(b"\n", 1)
+        reply = json.loads(line.decode("utf8"))
+        return reply if reply.get("ok") else None
+    def stat(self, path):
+        return self.request(op="stat", path=path)
+    def summaries(self, path, start, count=PAGE_SIZE):
+        reply = self.request(op="summaries", path=path, start=start, count=count)
+        return reply and reply["summaries"]
+
+
+_client = None
+_lastTry = 0
+
+def client():
+    """Return a Client connected to the daemon, or None if there
+    is no daemon running."""
+    global _client, _lastTry
+    if _client is not None:
+        return _client
+    now = time.time()
+    if now < _lastTry + RETRY_INTERVAL:
+        return None
+    _lastTry = now
+    path = socketPath()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(REPLY_TIMEOUT)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        writeLog("indexd not available: %s" % e)
+        sock.close()
+        return None
+    _client = Client(sock)
+    return _client
+
+def _dropClient():
+    global _client
+    if _client is not None:
+        _client.sock.close()
+        _client = None
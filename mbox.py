@@ -1,16 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf8 -*-
 
+import copy
 import email.parser
+import errno
 import os
 import socket
 import sys
 import time
 
+import cache
 import emailaccount
 import dotlock
 import filerange
-from utils import writeLog
+import indexd
+import msgindex
+import vfolder
+from utils import writeLog, human_readable, configGet
 
 if sys.platform.startswith('linux'):
     OS = 'Linux'
@@ -24,6 +30,7 @@ else:
     OS = 'Unknown'      # TODO: other operating systems as the need arises.
 
 HOST = socket.gethostname()
+COPY_CHUNK = 1<<20       # bytes per read/write when moving mail
 dummyMsgID = 1233
 
 def dummyMID():
@@ -31,6 +38,46 @@ def dummyMID():
     dummyMsgID += 1
     return "<%dGenerated@%s>" % (dummyMsgID, HOST)
 
+def _native(s):
+    """JSON hands back unicode; mailbox lines are native strings."""
+    if sys.version_info[0] < 3 and s is not None:
+        return s.encode("utf8")
+    return s
+
+def copyRange(ifd, ofd, src, dst, size):
+    """Copy size bytes from offset src of one file to offset dst
+    of another. Uses copy_file_range() where the OS supports it, so
+    the data never passes through user space; otherwise falls back
+    to read/write. Returns the number of bytes copied, which is less
+    than size if the source ends first."""
+    total = size
+    if hasattr(os, "copy_file_range"):
+        try:
+            while size > 0:
+                n = os.copy_file_range(ifd, ofd, size, src, dst)
+                if n <= 0:
+                    break
+                src += n
+                dst += n
+                size -= n
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                    errno.EOPNOTSUPP):
+                raise
+    while size > 0:
+        os.lseek(ifd, src, os.SEEK_SET)
+        buf = os.read(ifd, min(COPY_CHUNK, size))
+        if not buf:
+            break
+        os.lseek(ofd, dst, os.SEEK_SET)
+        while buf:
+            n = os.write(ofd, buf)
+            buf = buf[n:]
+            src += n
+            dst += n
+            size -= n
+    return total - size
+
 
 class MboxAccount(emailaccount.emailAccount):
     def __init__(self, name, path, config):
@@ -41,8 +88,25 @@ class MboxAccount(emailaccount.emailAccount):
             self.folder = config.get("mailrc","folder")
         else:
             self.folder = None
+        self.incFolder = configGet(config, "global", "incfolder", "inbox")
+        self.archivePattern = configGet(config, "global", "archivepattern",
+            "{name}-%Y-%m")
+        self.archiveDays = int(configGet(config, "global", "archivedays", "30"))
+        addresses = configGet(config, "global", "addresses")
+        if addresses:
+            emailaccount.setMyAddresses(addresses.split(","))
+        elif "USER" in os.environ:
+            user = os.environ["USER"]
+            emailaccount.setMyAddresses([user,
+                "%s@%s" % (user, socket.gethostname()),
+                "%s@%s" % (user, socket.getfqdn())])
+        self.searches = vfolder.fromConfig(self, config)
+        self.msgIndex = msgindex.MessageIdIndex(self)
         writeLog("New Berkeley mbox email box %s, %s" % (name, path))
 
+    def disconnect(self):
+        self.msgIndex.save()
+
     def getMboxes(self):
         self.boxes = [Mbox("INBOX", self.inbox)]
         if self.folder:
@@ -57,8 +121,210 @@ class MboxAccount(emailaccount.emailAccount):
                 self.boxes.sort()
             except Exception as e:
                 writeLog("Failed to read folder %s, %s" % (path, e))
+        self.msgIndex.watch()
         return self.boxes
 
+    def incorporate(self, callback=None, dest=None):
+        """Move all of the mail in the system mailbox into a folder
+        (default "inbox") in the mail folder directory, then empty
+        the system mailbox. The spool is only locked long enough to
+        summarize any mail not already scanned, copy it with
+        copy_file_range(), and truncate it. The summaries are
+        appended to the destination's summaries without rescanning.
+        The optional callback(mbox, count, pct, status, msg) is
+        called at the conclusion. Returns the number of messages
+        moved, or None on failure."""
+        if not self.folder:
+            writeLog("incorporate: no mail folder configured")
+            return None
+        if not self.boxes:
+            self.getMboxes()
+        spool = self.boxes[0]
+        destpath = os.path.join(self.folder, dest or self.incFolder)
+        for box in self.boxes:
+            if box.path == destpath:
+                target = box
+                break
+        else:
+            target = None
+
+        start = time.time()
+        sflock = sdlock = dflock = ddlock = None
+        sfd = os.open(spool.path, os.O_RDWR)
+        dfd = os.open(destpath, os.O_RDWR|os.O_CREAT, 0o600)
+        try:
+            sflock = dotlock.FileLock(sfd)
+            sdlock = dotlock.DotLock(spool.path)
+            dflock = dotlock.FileLock(dfd)
+            ddlock = dotlock.DotLock(destpath)
+            if not spool.lockboxes(sflock, sdlock) or \
+                    not spool.lockboxes(dflock, ddlock):
+                if callback:
+                    callback(spool, 0, 0, spool.STATE_LOCKED,
+                        "Failed to lock mailbox %s, timed out" % spool.path)
+                return None
+            size = os.fstat(sfd).st_size
+            # Summarize whatever we haven't already seen. Anything
+            # scanned before is still good as long as the spool
+            # has only been appended to.
+            if spool.checkForUpdates() == spool.BOX_CHANGED:
+                spool._reindex([])
+                spool.updates = spool.NO_UPDATES
+            with open(spool.path, "r") as ifile:
+                ifile.seek(spool.scannedSize())
+                while True:
+                    (msg, offset) = spool.getMessageSummary(ifile)
+                    if not msg:
+                        break
+                    spool._addSummary(msg)
+            summaries = spool._summaries
+            base = os.fstat(dfd).st_size
+            copied = copyRange(sfd, dfd, 0, base, size)
+            os.fsync(dfd)
+            if copied != size or os.fstat(dfd).st_size != base + size:
+                # Don't empty the spool unless all of it is safely
+                # in the folder
+                os.ftruncate(dfd, base)
+                os.fsync(dfd)
+                msg = "Copied only %d of %d bytes from %s to %s" % \
+                    (copied, size, spool.path, destpath)
+                writeLog("incorporate: " + msg)
+                if callback:
+                    callback(spool, 0, 0, spool.STATE_INTERRUPTED, msg)
+                return None
+            os.ftruncate(sfd, 0)
+        finally:
+            spool.unlockboxes(dflock, ddlock)
+            spool.unlockboxes(sflock, sdlock)
+            os.close(dfd)
+            os.close(sfd)
+
+        if target is None:
+            target = Mbox(os.path.basename(destpath), destpath)
+            self.boxes.append(target)
+            self.boxes.sort()
+        if not target.appendSummaries(summaries, base):
+            target.checkForUpdates()
+        spool._reindex([])
+        spool.size = 0
+        spool.lastModified = os.stat(spool.path).st_mtime
+        spool.updates = spool.NO_UPDATES
+
+        elapsed = max(time.time() - start, 1e-6)
+        report = "Incorporated %d messages (%s) into %s in %.2fs, %s/s" % \
+            (len(summaries), human_readable(size), target.name, elapsed,
+             human_readable(size/elapsed))
+        writeLog(report)
+        if callback:
+            callback(target, len(summaries), 100., spool.STATE_FINISHED, report)
+        return len(summaries)
+
+    def archive(self, box, callback=None, pattern=None, days=None):
+        """Move messages more than days old (default 30) out of this
+        mailbox into archive folders in the mail folder directory.
+        Messages are grouped by date; the folder name is the strftime()
+        pattern (default "{name}-%Y-%m") applied to the message date,
+        with {name} replaced by the mailbox name. The summaries are
+        walked once; each archive folder is opened and locked once,
+        and consecutive messages bound for the same folder are copied
+        as one range. The archive folders' summaries are updated
+        without rescanning, and the source mailbox is then expunged.
+        Returns the number of messages archived, or None on failure."""
+        if not self.folder:
+            writeLog("archive: no mail folder configured")
+            return None
+        if box.state != box.STATE_FINISHED or \
+                box.checkForUpdates() == box.BOX_CHANGED:
+            if box.getOverview(callback) != box.STATE_FINISHED:
+                return None
+        pattern = pattern or self.archivePattern
+        cutoff = time.time() - (self.archiveDays if days is None else days) * 86400
+        FLAG_DELETED = emailaccount.messageSummary.FLAG_DELETED
+
+        start = time.time()
+        targets = {}        # name => _archiveTarget
+        moved = []
+        copied = 0
+        sfd = os.open(box.path, os.O_RDONLY)
+        flock = dotlock.FileLock(sfd)
+        dlock = dotlock.DotLock(box.path)
+        try:
+            if not box.lockboxes(flock, dlock):
+                if callback:
+                    callback(box, 0, 0, box.STATE_LOCKED,
+                        "Failed to lock mailbox %s, timed out" % box.path)
+                return None
+            for msg in box.summaries():
+                # (Messages with no date stay where they are)
+                if msg.status & FLAG_DELETED or not msg.udate or \
+                        msg.udate >= cutoff:
+                    continue
+                name = time.strftime(pattern, time.localtime(msg.udate))
+                name = name.replace("{name}", box.name)
+                target = targets.get(name)
+                if target is None:
+                    path = os.path.join(self.folder, name)
+                    if path == box.path:
+                        continue
+                    target = _archiveTarget(path)
+                    if not target.lock(box):
+                        # Back out what we've copied so far
+                        target.discard()
+                        target.close(box)
+                        for t in targets.values():
+                            t.discard()
+                        if callback:
+                            callback(box, len(moved), 0, box.STATE_LOCKED,
+                                "Failed to lock mailbox %s, timed out" % path)
+                        return None
+                    targets[name] = target
+                copied += target.add(sfd, msg)
+                moved.append(msg)
+            for target in targets.values():
+                copied += target.flush(sfd)
+                os.fsync(target.fd)
+        finally:
+            for target in targets.values():
+                target.close(box)
+            box.unlockboxes(flock, dlock)
+            os.close(sfd)
+
+        for name, target in targets.items():
+            for dbox in self.boxes:
+                if dbox.path == target.path:
+                    break
+            else:
+                dbox = Mbox(name, target.path)
+                self.boxes.append(dbox)
+            if not dbox.appendSummaries(target.summaries, target.base):
+                dbox.checkForUpdates()
+        self.boxes.sort()
+
+        box.chFlagsMany(moved, FLAG_DELETED, 0)
+        if box.expunge(callback) != box.STATE_FINISHED:
+            # The messages are still here, so take them out of the
+            # archive folders again
+            box.chFlagsMany(moved, 0, FLAG_DELETED)
+            for target in targets.values():
+                if not target.rollback(box):
+                    writeLog("archive: could not remove the copies from %s"
+                        % target.path)
+            self.boxes = [b for b in self.boxes if os.path.exists(b.path)]
+            paths = set(target.path for target in targets.values())
+            for dbox in self.boxes:
+                if dbox.path in paths:
+                    dbox.checkForUpdates()
+            return None
+
+        elapsed = max(time.time() - start, 1e-6)
+        report = "Archived %d messages (%s) from %s into %d folders in %.2fs, %s/s" % \
+            (len(moved), human_readable(copied), box.name, len(targets),
+             elapsed, human_readable(copied/elapsed))
+        writeLog(report)
+        if callback:
+            callback(box, len(moved), 100., box.STATE_FINISHED, report)
+        return len(moved)
+
     @staticmethod
     def exclude(name):
         """Patterns that are not legit mailbox folders."""
@@ -66,16 +332,103 @@ class MboxAccount(emailaccount.emailAccount):
                 not name.startswith('.')
 
 
+class _archiveTarget(object):
+    """One destination file of MboxAccount.archive(). Runs of
+    messages that are adjacent in the source are copied as one."""
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.flock = None
+        self.dlock = dotlock.DotLock(path)
+        self.created = False    # True if the file is new
+        self.base = None        # size of the file before we started
+        self.pos = None         # where the next run goes
+        self.runStart = self.runEnd = None
+        self.summaries = []     # relative to base
+    def add(self, sfd, msg):
+        """Queue this message for copying, return # bytes copied."""
+        if self.base is None:
+            self.base = self.pos = os.fstat(self.fd).st_size
+        copied = 0
+        if msg.offset != self.runEnd:
+            copied = self.flush(sfd)
+            self.runStart = msg.offset
+        self.runEnd = msg.offset + msg.size
+        summary = copy.copy(msg)
+        summary.offset = self.pos - self.base + msg.offset - self.runStart
+        self.summaries.append(summary)
+        return copied
+    def lock(self, box):
+        """Open and lock the file. A file which doesn't exist yet is
+        created only once its dotlock is held, so that a failure
+        leaves nothing behind. Returns False on failure."""
+        if os.path.exists(self.path):
+            self.fd = os.open(self.path, os.O_RDWR)
+            self.flock = dotlock.FileLock(self.fd)
+            return box.lockboxes(self.flock, self.dlock)
+        if not self.dlock.lock(30):
+            return False
+        try:
+            self.fd = os.open(self.path, os.O_RDWR|os.O_CREAT|os.O_EXCL, 0o600)
+        except OSError as e:
+            writeLog("archive: cannot create %s: %s" % (self.path, e))
+            self.dlock.unlock()
+            return False
+        self.created = True
+        self.flock = dotlock.FileLock(self.fd)
+        return self.flock.lock(30)
+    def close(self, box):
+        box.unlockboxes(self.flock, self.dlock)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+    def discard(self):
+        """While still locked, undo what has been copied."""
+        if self.base is not None:
+            os.ftruncate(self.fd, self.base)
+        if self.created:
+            os.unlink(self.path)
+    def rollback(self, box):
+        """After close(), cut the file back to its size before we
+        started, provided nothing has been added since. Returns True
+        on success."""
+        if self.base is None:
+            return True
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except OSError:
+            return False
+        self.fd = fd
+        self.flock = dotlock.FileLock(fd)
+        try:
+            if not box.lockboxes(self.flock, self.dlock) or \
+                    os.fstat(fd).st_size != self.pos:
+                return False
+            self.discard()
+            return True
+        finally:
+            self.close(box)
+    def flush(self, sfd):
+        """Copy out the current run, return # bytes copied."""
+        if self.runStart is None:
+            return 0
+        size = self.runEnd - self.runStart
+        copyRange(sfd, self.fd, self.runStart, self.pos, size)
+        self.pos += size
+        self.runStart = self.runEnd = None
+        return size
+
+
 class Mbox(emailaccount.mailbox):
     """I had hoped to use mailbox.mbox here, but it just doesn't
     do everything I need. I don't think it was designed for
     some of the truly massive mboxes I have in mind."""
+    useIndexer = True       # Ask the indexer daemon before scanning
     def __init__(self, name, path):
         super(Mbox,self).__init__(name, path)
         self.size = os.path.getsize(path)
         self.parser = email.parser.Parser()
         self.busy = False               # Unavailable if True
-        self.busy = name[1] is 'e'
         self._summaries = []
         self.msgdict = {}
         self.nUnread = 0
@@ -166,9 +519,17 @@ class Mbox(emailaccount.mailbox):
 
         # TODO: run this in a background thread
 
-        if self.updates == self.BOX_CHANGED:
-            # Need to start fresh
-            self._summaries = []
+        if self.updates == self.BOX_CHANGED or not self._summaries:
+            # Need to start fresh, before the cache or the indexer
+            # adds anything
+            self._reindex([])
+        if not self._summaries and self.loadCache():
+            writeLog("Loaded %d summaries for %s from cache" % \
+                (len(self._summaries), self.name))
+        if self.fetchFromIndexer(callback) == self.STATE_INTERRUPTED:
+            self.updates = self.NO_UPDATES
+            self._state = self.STATE_INTERRUPTED
+            return self.STATE_INTERRUPTED
 
         start = lastcb = lastrefresh = time.time()
         # Scan the mailbox, generating {to,from,subject,date,msgid,offset,size}
@@ -176,16 +537,13 @@ class Mbox(emailaccount.mailbox):
         # Every ten messages, check the time.
         # Every 0.5 seconds, send an update
         # Every 5 seconds, refresh the dotlock
-        msgcount = len(self._summaries)    # Only check every 100 messages
+        msgcount = count0 = len(self._summaries)
         if self._summaries:
             lastOffset = self._summaries[-1].offset
             offset = lastOffset + self._summaries[-1].size
         else:
             lastOffset = 0  # Offset of last seen "From " line.
             offset = 0      # file offset
-            self.msgdict = {}
-            self.nUnread = 0
-            self.nNew = 0
         # Programming note: I originally did "with open(...) as ifile",
         # but it resulted in "'I/O operation on closed file' in  ignored"
         flock = dlock = None
@@ -209,15 +567,8 @@ class Mbox(emailaccount.mailbox):
                     (msg, offset) = self.getMessageSummary(ifile)
                     if not msg:
                         break
-                    # We prefer X-UID as the dictionary key, else we'll use
-                    # the message id.
-                    msg.idx = msgcount
-                    key = msg.key
-                    self._summaries.append(msg)
-                    self.msgdict[key] = msg
+                    self._addSummary(msg)
                     msgcount += 1
-                    if msg.status & msg.FLAG_NEW: self.nNew += 1
-                    if not (msg.status & msg.FLAG_READ): self.nUnread += 1
                     if msgcount % 10 == 0:
                         now = time.time()
                         if now > lastcb + 0.5:
@@ -229,6 +580,8 @@ class Mbox(emailaccount.mailbox):
                                 lastrefresh = now
                                 dlock.refresh()
                 except KeyboardInterrupt:
+                    if msgcount > count0:
+                        self.saveCache()
                     if callback:
                         callback(self, msgcount, 100.*offset/self.size,
                             self.STATE_INTERRUPTED, "Interrupted by user")
@@ -240,12 +593,211 @@ class Mbox(emailaccount.mailbox):
             self.unlockboxes(flock, dlock)
             ifile.close()
 
+        if msgcount > count0:
+            writeLog("%s: scanned %d messages; %s" % (self.name,
+                msgcount - count0, emailaccount.memoReport()))
+            self.saveCache()
         if callback:
             callback(self, msgcount,100., self.STATE_FINISHED, None)
         self.updates = self.NO_UPDATES
         self._state = self.STATE_FINISHED
         return self.STATE_FINISHED
 
+    def loadCache(self):
+        """If there is a cache of summaries for this mailbox that is
+        still consistent with the file, adopt it. Scanning can then
+        resume from the end of the cached data. Returns True if the
+        cache was used."""
+        data = cache.load(self.path)
+        if not data:
+            return False
+        summaries = data["summaries"]
+        if not summaries or not self._consistent(summaries[0].offset,
+                data["firstFrom"], summaries[-1].offset, data["lastFrom"],
+                data["size"]):
+            return False
+        if data.get("addresses") != emailaccount.myAddresses():
+            for msg in summaries:
+                msg.setAddressFlags()
+        self._reindex(summaries)
+        self.lastFrom = data["lastFrom"]
+        return True
+
+    def saveCache(self):
+        """Write the current summaries to the cache."""
+        if not self._summaries:
+            cache.remove(self.path)
+            return False
+        firstFrom = self.firstFrom()
+        if firstFrom is None:
+            return False
+        summaries = self._fileSummaries()
+        if summaries is None:
+            return False
+        if not cache.save(self.path, {"summaries": summaries,
+                "size": self.scannedSize(), "firstFrom": firstFrom,
+                "lastFrom": self.lastFrom,
+                "addresses": emailaccount.myAddresses()}):
+            return False
+        self._notify("saved")
+        return True
+
+    def _fileSummaries(self):
+        """Return the summaries as the file has them: any whose flags
+        have been changed but not saved are replaced by copies with
+        the flags read back from the file. Returns None on error."""
+        if not self.modified:
+            return self._summaries
+        ADDRESS_FLAGS = messageSummary.FLAG_DIRECT|messageSummary.FLAG_CC
+        summaries = list(self._summaries)
+        try:
+            with open(self.path, "r") as ifile:
+                for i,msg in enumerate(summaries):
+                    if not msg.modified:
+                        continue
+                    ifile.seek(msg.offset)
+                    if not ifile.readline().startswith("From "):
+                        return None
+                    msg = summaries[i] = copy.copy(msg)
+                    msg.status = self.headerStatus(self.readHeaders(ifile)) | \
+                        msg.status & ADDRESS_FLAGS
+                    msg.modified = False
+        except (IOError, OSError) as e:
+            writeLog("Failed to read flags from %s: %s" % (self.path, e))
+            return None
+        return summaries
+
+    def fetchFromIndexer(self, callback):
+        """If the indexer daemon has more of this mailbox than we do,
+        page its summaries in rather than scanning for them. Returns
+        STATE_FINISHED if anything was fetched, STATE_INTERRUPTED
+        if interrupted, or None."""
+        if not self.useIndexer:
+            return None
+        client = indexd.client()
+        if client is None:
+            return None
+        path = os.path.abspath(self.path)
+        stat = client.stat(path)
+        start = len(self._summaries)
+        if not stat or stat["count"] <= start or \
+                not self._consistent(stat["firstOffset"],
+                    _native(stat["firstFrom"]), stat["lastOffset"],
+                    _native(stat["lastFrom"]), stat["size"]):
+            return None
+        total = stat["count"]
+        while start < total:
+            try:
+                page = client.summaries(path, start)
+                if not page or page[0]["offset"] != self.scannedSize():
+                    # The daemon's view changed under us; scan the rest.
+                    return self.STATE_FINISHED
+                for d in page:
+                    self._addSummary(messageSummary.fromDict(d))
+                start += len(page)
+                if callback:
+                    callback(self, start, 100.*start/total,
+                        self.STATE_READING, None)
+            except KeyboardInterrupt:
+                if callback:
+                    callback(self, start, 100.*start/total,
+                        self.STATE_INTERRUPTED, "Interrupted by user")
+                return self.STATE_INTERRUPTED
+        self.lastFrom = _native(stat["lastFrom"])
+        writeLog("Fetched %d summaries for %s from indexd" % (total, self.name))
+        return self.STATE_FINISHED
+
+    def firstFrom(self):
+        """Return the "From " line of the first message, or None."""
+        if not self._summaries:
+            return None
+        try:
+            with open(self.path, "r") as ifile:
+                ifile.seek(self._summaries[0].offset)
+                return ifile.readline()
+        except (IOError, OSError):
+            return None
+
+    def _consistent(self, firstOffset, firstFrom, lastOffset, lastFrom, size):
+        """Summary data that was taken from this mailbox when the
+        first message started at firstOffset with firstFrom, the last
+        at lastOffset with lastFrom, and size bytes had been scanned,
+        is still valid if the mailbox has only been appended to since."""
+        try:
+            if os.path.getsize(self.path) < size:
+                return False
+            with open(self.path, "r") as ifile:
+                ifile.seek(firstOffset)
+                if ifile.readline() != firstFrom:
+                    return False
+                ifile.seek(lastOffset)
+                return ifile.readline() == lastFrom
+        except (IOError, OSError):
+            return False
+
+    def _addSummary(self, msg):
+        """Append one message summary and account for it."""
+        # We prefer X-UID as the dictionary key, else we'll use
+        # the message id.
+        status, original = msg.status, msg.originalStatus
+        msg.idx = len(self._summaries)
+        self._summaries.append(msg)
+        self.msgdict[msg.key] = msg
+        self.flagArray.append(status, original)
+        msg.flagArray = self.flagArray
+        self._indexSummary(msg)
+        self._notify("append", msg)
+        if not status & msg.FLAG_DELETED:
+            if status & msg.FLAG_NEW: self.nNew += 1
+            if not (status & msg.FLAG_READ): self.nUnread += 1
+
+    def scannedSize(self):
+        """Return the file offset just past the last scanned message."""
+        if not self._summaries:
+            return 0
+        return self._summaries[-1].offset + self._summaries[-1].size
+
+    def findOffset(self, offset):
+        """Return the index of the message at this file offset, or
+        None if there isn't one."""
+        summaries = self._summaries
+        lo, hi = 0, len(summaries or ())
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if summaries[mid].offset < offset:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(summaries or ()) and summaries[lo].offset == offset:
+            return lo
+        return None
+
+    def appendSummaries(self, summaries, base):
+        """Messages with these summaries, taken from some other
+        mailbox, have just been appended to this mailbox's file
+        starting at offset base. Record them without rescanning.
+        The summaries are copied; the originals are not touched.
+        Returns False if our own summaries are not current, in which
+        case the new mail is left for the next scan to find."""
+        if self.updates == self.BOX_CHANGED or self.scannedSize() != base or \
+                (base and self._state != self.STATE_FINISHED):
+            return False
+        for msg in summaries:
+            msg = copy.copy(msg)
+            msg.offset = msg.offset + base
+            msg.client = None
+            self._addSummary(msg)
+        if self._summaries:
+            with open(self.path, "r") as ifile:
+                ifile.seek(self._summaries[-1].offset)
+                self.lastFrom = ifile.readline()
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.lastModified = stat.st_mtime
+        self._state = self.STATE_FINISHED
+        self.saveCache()
+        return True
+
     def getMessageSummary(self, ifile):
         """Scan for a "From " line, return its key headers."""
         # scan to "From " line, it *ought* to be the first one, but no
@@ -262,29 +814,42 @@ class Mbox(emailaccount.mailbox):
         msg = messageSummary()
         msg.offset = offset0
         msg.size = offset - offset0
-        if "From" in fullhdrs: msg.From = fullhdrs["From"]
-        if "To" in fullhdrs: msg.To = fullhdrs["To"]
+        intern = emailaccount.internValue
+        if "From" in fullhdrs: msg.From = intern(fullhdrs["From"])
+        if "To" in fullhdrs: msg.To = intern(fullhdrs["To"])
+        if "Cc" in fullhdrs: msg.Cc = intern(fullhdrs["Cc"])
+        elif "CC" in fullhdrs: msg.Cc = intern(fullhdrs["CC"])
         if "Subject" in fullhdrs: msg.Subject = fullhdrs["Subject"]
         if "Date" in fullhdrs:
             msg.Date = fullhdrs["Date"]
             msg.parseDate()
-        if "Status" in fullhdrs:
-            status = fullhdrs["Status"]
-            if 'R' in status: msg.status |= msg.FLAG_READ
-            if 'O' not in status: msg.status |= msg.FLAG_NEW
-        if "X-Status" in fullhdrs:
-            status = fullhdrs["X-Status"]
-            if 'A' in status: msg.status |= msg.FLAG_ANSWERED
-            if 'F' in status: msg.status |= msg.FLAG_FLAGGED
-            if 'D' in status: msg.status |= msg.FLAG_DELETED
+        msg.status = self.headerStatus(fullhdrs) | \
+            emailaccount.addressFlags(msg.To, msg.Cc)
         if "X-UID" in fullhdrs: msg.uid = fullhdrs["X-UID"]
         if "Message-Id" in fullhdrs: msg.MessageId = fullhdrs["Message-Id"]
         elif "Message-ID" in fullhdrs: msg.MessageId = fullhdrs["Message-ID"]
+        if "In-Reply-To" in fullhdrs: msg.InReplyTo = fullhdrs["In-Reply-To"]
+        if "References" in fullhdrs: msg.References = fullhdrs["References"]
         if msg.uid: msg.key = msg.uid
         elif msg.MessageId: msg.key = msg.MessageId
         else: msg.key = dummyMID()
         return (msg, offset)
 
+    @staticmethod
+    def headerStatus(fullhdrs):
+        """Return the flags given by the Status and X-Status headers."""
+        status = 0
+        if "Status" in fullhdrs:
+            value = fullhdrs["Status"]
+            if 'R' in value: status |= messageSummary.FLAG_READ
+            if 'O' not in value: status |= messageSummary.FLAG_NEW
+        if "X-Status" in fullhdrs:
+            value = fullhdrs["X-Status"]
+            if 'A' in value: status |= messageSummary.FLAG_ANSWERED
+            if 'F' in value: status |= messageSummary.FLAG_FLAGGED
+            if 'D' in value: status |= messageSummary.FLAG_DELETED
+        return status
+
     @staticmethod
     def flushMessage(ifile):
         """Read and discard input until find "From " line. Return file offset"""
@@ -298,6 +863,176 @@ class Mbox(emailaccount.mailbox):
                 return offset
 
 
+    def expunge(self, callback=None):
+        """Remove all messages flagged FLAG_DELETED from the mailbox
+        file. The optional callback(mbox, count, pct, status, msg)
+        is called every 0.5 seconds or so, and at the conclusion
+        with a throughput report.
+
+        If all of the deleted messages are at the end of the file,
+        the file is simply truncated. Otherwise, each run of
+        retained messages is copied down over the gap in a single
+        streamed copy; this makes purging a block of old messages
+        from the front of a mailbox one copy instead of one per
+        message."""
+        if not self._summaries:
+            return self.STATE_FINISHED
+        if self.checkForUpdates() == self.BOX_CHANGED:
+            if callback:
+                callback(self, 0, 0, self.STATE_INTERRUPTED,
+                    "Mailbox %s has been modified, reload required" % self.name)
+            return self.STATE_INTERRUPTED
+        summaries = self._summaries
+        FLAG_DELETED = emailaccount.messageSummary.FLAG_DELETED
+        first = None
+        for i,msg in enumerate(summaries):
+            if msg.status & FLAG_DELETED:
+                first = i
+                break
+        if first is None:
+            return self.STATE_FINISHED
+
+        start = time.time()
+        flock = dlock = None
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            flock = dotlock.FileLock(fd)
+            dlock = dotlock.DotLock(self.path)
+            if not self.lockboxes(flock, dlock):
+                if callback:
+                    callback(self, 0, 0, self.STATE_LOCKED,
+                        "Failed to lock mailbox %s, timed out" % self.path)
+                return self.STATE_LOCKED
+            self._state = self.STATE_SAVING
+            fsize = os.fstat(fd).st_size
+            scanEnd = summaries[-1].offset + summaries[-1].size
+            wpos = summaries[first].offset      # write position
+            copied = 0
+            kept = summaries[:first]
+            if fsize == scanEnd and \
+                    all(m.status & FLAG_DELETED for m in summaries[first:]):
+                # Fast path: everything to go is at the end of the file.
+                os.ftruncate(fd, wpos)
+            else:
+                # Coalesce adjacent retained messages into runs, and
+                # move each run down with one streamed copy.
+                lastcb = lastrefresh = time.time()
+                runStart = None
+                for msg in summaries[first:]:
+                    if msg.status & FLAG_DELETED:
+                        if runStart is not None:
+                            copied += self._moveRun(fd, runStart, wpos, msg.offset)
+                            wpos += msg.offset - runStart
+                            runStart = None
+                        continue
+                    if runStart is None:
+                        runStart = msg.offset
+                        delta = msg.offset - wpos
+                    msg.offset -= delta
+                    kept.append(msg)
+                    now = time.time()
+                    if now > lastcb + 0.5:
+                        lastcb = now
+                        if callback:
+                            callback(self, len(kept), 100.*copied/fsize,
+                                self.STATE_SAVING, None)
+                        if now > lastrefresh + 5.0:
+                            lastrefresh = now
+                            dlock.refresh()
+                # Final run includes anything appended since the last scan.
+                if runStart is None:
+                    runStart = scanEnd
+                copied += self._moveRun(fd, runStart, wpos, fsize)
+                wpos += fsize - runStart
+                os.ftruncate(fd, wpos)
+            st = os.fstat(fd)
+        finally:
+            self.unlockboxes(flock, dlock)
+            os.close(fd)
+
+        removed = len(summaries) - len(kept)
+        freed = fsize - wpos
+        self._reindex(kept)
+        if kept:
+            with open(self.path, "r") as ifile:
+                ifile.seek(kept[-1].offset)
+                self.lastFrom = ifile.readline()
+        self.size = st.st_size
+        self.lastModified = st.st_mtime
+        self.modified = any(m.modified for m in kept)
+        self.saveCache()
+        self._state = self.STATE_FINISHED
+        self.updates = self.BOX_APPENDED if fsize > scanEnd else self.NO_UPDATES
+
+        elapsed = max(time.time() - start, 1e-6)
+        report = "Expunged %d messages (%s) from %s, moved %s in %.2fs, %s/s" % \
+            (removed, human_readable(freed), self.name, human_readable(copied),
+             elapsed, human_readable(copied/elapsed))
+        writeLog(report)
+        if callback:
+            callback(self, len(kept), 100., self.STATE_FINISHED, report)
+        return self.STATE_FINISHED
+
+    def purge(self, days, callback=None):
+        """Expunge messages more than the given number of days old
+        from the front of the mailbox. Assumes the mailbox is in
+        date order, as a Trash folder normally is, and stops at
+        the first message that is new enough to keep. Messages with
+        no date are kept. The retained suffix is moved to the front
+        of the file in one streamed copy. Returns the state, as with
+        expunge()."""
+        if not self._summaries:
+            return self.STATE_FINISHED
+        cutoff = time.time() - days * 86400
+        FLAG_DELETED = emailaccount.messageSummary.FLAG_DELETED
+        old = []
+        for msg in self._summaries:
+            if msg.udate is None:
+                continue
+            if msg.udate >= cutoff:
+                break
+            old.append(msg)
+        self.chFlagsMany(old, FLAG_DELETED, 0)
+        return self.expunge(callback)
+
+    @staticmethod
+    def _moveRun(fd, src, dst, end):
+        """Copy bytes [src,end) of the file down to dst. Return
+        the number of bytes moved."""
+        if src == dst:
+            return 0
+        pos = src
+        while pos < end:
+            os.lseek(fd, pos, os.SEEK_SET)
+            buf = os.read(fd, min(COPY_CHUNK, end - pos))
+            if not buf:
+                break
+            os.lseek(fd, dst + pos - src, os.SEEK_SET)
+            while buf:
+                n = os.write(fd, buf)
+                buf = buf[n:]
+                pos += n
+        return pos - src
+
+    def _reindex(self, summaries):
+        """Replace the summary list after the file has been rewritten,
+        rebuilding the dictionary and counts to match."""
+        self._summaries = summaries
+        self.msgdict = {}
+        self._resetIndexes()
+        flags = self.flagArray = emailaccount.FlagArray(
+            [msg.status for msg in summaries],
+            [msg.originalStatus for msg in summaries])
+        for i,msg in enumerate(summaries):
+            msg.idx = i
+            msg.flagArray = flags
+            self.msgdict[msg.key] = msg
+            self._indexSummary(msg)
+        self._recount()
+        if not summaries:
+            self.lastFrom = None
+        self._notify("reset")
+
     def lockboxes(self, filelock, dotlock):
         """Acquire both locks. Return False on failure."""
         if not filelock.lock(30):
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Account-wide index of Message-IDs, for finding a message (e.g.
+the parent of a reply) without knowing which mailbox it was filed
+in. The index is divided into one shard per mailbox, each holding
+that mailbox's Message-ID => file offset table and a Bloom filter
+of its Message-IDs. Both are kept in the cache; the Bloom filters
+are small, so a lookup reads them all and then loads the tables of
+only those mailboxes whose filter says they might hold the ID.
+
+Shards are kept up to date by listening to the mailboxes as they
+are scanned, and are saved whenever the mailbox saves its own
+summaries. X-UIDs are only unique within one mailbox, so they stay
+in each mailbox's msgdict and are not indexed here."""
+
+from __future__ import print_function
+
+import hashlib
+import os
+import re
+import struct
+import sys
+
+import cache
+from utils import writeLog
+
+PY3 = sys.version_info[0] >= 3
+
+BLOOM_BITS = 10         # bits per item, for about 1% false positives
+BLOOM_HASHES = 7
+MIN_CAPACITY = 1024
+
+msgid_re = re.compile(r"<[^<>]+>")
+
+def normalize(value):
+    """Return the Message-ID from a header value, or None."""
+    if not value:
+        return None
+    ids = msgid_re.findall(value)
+    return ids[0] if ids else value.strip() or None
+
+def parentId(inReplyTo, references):
+    """Return the Message-ID of the parent of a message, given its
+    In-Reply-To and References headers, or None."""
+    if inReplyTo:
+        msgid = normalize(inReplyTo)
+        if msgid:
+            return msgid
+    if references:
+        ids = msgid_re.findall(references)
+        if ids:
+            return ids[-1]
+    return None
+
+
+class Bloom(object):
+    """Bloom filter over strings."""
+    def __init__(self, capacity, bits=None):
+        self.capacity = max(capacity, MIN_CAPACITY)
+        self.nbits = self.capacity * BLOOM_BITS
+        self.bits = bytearray(bits) if bits is not None else \
+            bytearray((self.nbits + 7) // 8)
+    def _positions(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode("utf8")
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        nbits = self.nbits
+        return [(h1 + i*h2) % nbits for i in range(BLOOM_HASHES)]
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class Shard(object):
+    """The Message-IDs of one mailbox."""
+    def __init__(self, box):
+        self.box = box
+        self.ids = None         # Message-ID => offset, None if not loaded
+        self.bloom = None
+        self.meta = None        # as saved; validates the saved data
+        self.count = 0          # summaries covered
+        self.firstOffset = self.lastOffset = None
+        self.dirty = False
+
+    def load(self):
+        """Load the Bloom filter from the cache if it's still valid
+        for the mailbox file. Returns True if there's a usable
+        shard."""
+        if self.bloom is not None:
+            return True
+        data = cache.load(self.box.path, "bloom")
+        if not data or not data["count"] or not self.box._consistent(
+                data["firstOffset"], data["firstFrom"],
+                data["lastOffset"], data["lastFrom"], data["size"]):
+            return False
+        self.bloom = Bloom(data["capacity"], data["bits"])
+        self.meta = data
+        self.count = data["count"]
+        self.firstOffset = data["firstOffset"]
+        self.lastOffset = data["lastOffset"]
+        return True
+
+    def loadIds(self):
+        """Make sure the Message-ID table is in memory."""
+        if self.ids is not None:
+            return True
+        data = self.load() and cache.load(self.box.path, "msgids")
+        if not data:
+            self.reset(0)
+            return False
+        self.ids = data["ids"]
+        return True
+
+    def complete(self):
+        """True if everything in the mailbox file is covered."""
+        try:
+            size = os.path.getsize(self.box.path)
+        except OSError:
+            return True
+        if self.box.summaries():
+            return self.box.scannedSize() >= size
+        return self.meta is not None and self.meta["size"] >= size
+
+    def reset(self, capacity):
+        self.ids = {}
+        self.bloom = Bloom(capacity * 2)
+        self.meta = None
+        self.count = 0
+        self.firstOffset = self.lastOffset = None
+        self.dirty = True
+
+    def add(self, summary):
+        msgid = normalize(summary.MessageId)
+        if msgid:
+            self.ids[msgid] = summary.offset
+            if self.count >= self.bloom.capacity:
+                self.bloom = Bloom(self.count * 2)
+                for key in self.ids:
+                    self.bloom.add(key)
+            else:
+                self.bloom.add(msgid)
+        if self.firstOffset is None:
+            self.firstOffset = summary.offset
+        self.lastOffset = summary.offset
+        self.count += 1
+        self.dirty = True
+
+    def sync(self):
+        """Bring the shard up to date with the mailbox's summaries."""
+        summaries = self.box.summaries()
+        if not summaries:
+            return
+        self.loadIds()
+        n = self.count
+        if n > len(summaries) or (n and (
+                summaries[0].offset != self.firstOffset or
+                summaries[n-1].offset != self.lastOffset)):
+            self.reset(len(summaries))
+        for summary in summaries[self.count:]:
+            self.add(summary)
+
+    def save(self):
+        box = self.box
+        summaries = box.summaries()
+        if not self.dirty or not summaries or self.count != len(summaries):
+            return
+        firstFrom = box.firstFrom()
+        if firstFrom is None:
+            return
+        self.meta = {"count": self.count, "capacity": self.bloom.capacity,
+            "bits": bytes(self.bloom.bits),
+            "firstOffset": self.firstOffset, "firstFrom": firstFrom,
+            "lastOffset": self.lastOffset, "lastFrom": box.lastFrom,
+            "size": box.scannedSize()}
+        if cache.save(box.path, {"ids": self.ids}, "msgids") and \
+                cache.save(box.path, dict(self.meta), "bloom"):
+            self.dirty = False
+
+    def get(self, msgid):
+        """Return the offset of the message with this ID, or None."""
+        if self.box.summaries():
+            self.sync()
+        elif not self.load() or msgid not in self.bloom:
+            return None
+        if not self.loadIds():
+            return None
+        return self.ids.get(msgid)
+
+
+class MessageIdIndex(object):
+    """Message-ID index over all the mailboxes of an account."""
+    def __init__(self, account):
+        self.account = account
+        self.shards = {}        # mailbox path => Shard
+
+    def watch(self):
+        """Start following any of the account's mailboxes that we
+        aren't following yet."""
+        for box in self.account.boxes:
+            path = os.path.abspath(box.path)
+            shard = self.shards.get(path)
+            if shard is not None and shard.box is box:
+                continue
+            if shard is not None:
+                shard.box.removeListener(self.update)
+            shard = self.shards[path] = Shard(box)
+            box.addListener(self.update)
+            shard.sync()
+
+    def update(self, box, event, summary):
+        """Listener for changes to the mailboxes."""
+        shard = self.shards.get(os.path.abspath(box.path))
+        if shard is None or shard.box is not box:
+            return
+        if event == "append":
+            if shard.ids is not None and shard.count == summary.idx:
+                shard.add(summary)
+            else:
+                shard.sync()
+        elif event == "reset":
+            shard.sync()
+        elif event == "saved":
+            shard.save()
+
+    def find(self, msgid, callback=None):
+        """Return the list of (mailbox, offset) of the messages with
+        this Message-ID. Mailboxes whose shard can't hold the ID are
+        skipped; mailboxes which have not been completely indexed
+        are scanned, but only if the ID isn't found elsewhere first.
+        The optional callback is passed to getOverview() for those."""
+        self.watch()
+        msgid = normalize(msgid)
+        if not msgid:
+            return []
+        found = []
+        unindexed = []
+        for shard in self.shards.values():
+            offset = shard.get(msgid)
+            if offset is not None:
+                found.append((shard.box, offset))
+            elif not shard.complete():
+                unindexed.append(shard)
+        for shard in unindexed:
+            if found:
+                break
+            writeLog("msgindex: scanning %s for %s" % (shard.box.name, msgid))
+            status = shard.box.getOverview(callback)
+            offset = shard.get(msgid)
+            if offset is not None:
+                found.append((shard.box, offset))
+            if status != shard.box.STATE_FINISHED:
+                break
+        self.save()
+        return found
+
+    def save(self):
+        for shard in self.shards.values():
+            shard.save()
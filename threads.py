@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Conversation threads, after Jamie Zawinski's threading algorithm
+(https://www.jwz.org/doc/threading.html).
+
+Every Message-ID seen, on a message or only in the References or
+In-Reply-To of one, gets a container. A message's references link
+their containers into a chain, and the message goes under the last
+of them. A message with a reply subject ("Re: ...") whose thread
+has no known top goes under the first message seen with the same
+subject.
+
+Unlike the published algorithm, empty containers are not pruned
+from the forest; they are skipped when it is flattened for display.
+That way messages can be added one at a time as mail arrives: a
+message that was only referenced before simply fills its container.
+The forest is kept in the cache as a table of containers, and
+brought up to date with any messages appended since."""
+
+from __future__ import print_function
+
+import array
+
+import cache
+import msgindex
+from emailaccount import normalizeSubject, reply_re
+
+MAXDEPTH = 12           # deeper messages are shown at this depth
+
+
+class Container(object):
+    __slots__ = ("msgid", "summary", "parent", "children")
+    def __init__(self, msgid):
+        self.msgid = msgid
+        self.summary = None
+        self.parent = None
+        self.children = []
+
+
+class Forest(object):
+    """The threads of one mailbox. Use get() to obtain the forest
+    for a mailbox rather than creating one directly."""
+    def __init__(self, box):
+        self.box = box
+        self.saved = None       # cached data not yet adopted
+        self.reset(None)
+
+    def reset(self, source):
+        self.containers = []    # in order of creation
+        self.byId = {}          # Message-ID => Container
+        self.bySubject = {}     # normalized subject => first Container
+        self.nodes = {}         # summary => Container
+        self.source = source    # the summaries being threaded
+        self.count = 0          # how many of them have been
+        self.dirty = True
+
+    def load(self):
+        """Read the forest from the cache, to be adopted by sync() if
+        it still matches the mailbox."""
+        if self.box.path:
+            self.saved = cache.load(self.box.path, "threads")
+
+    def save(self):
+        box = self.box
+        summaries = self.source
+        if not self.dirty or not box.path or not summaries or \
+                summaries is not box.summaries():
+            return
+        index = dict((c, i) for i,c in enumerate(self.containers))
+        positions = dict((s, i) for i,s in enumerate(summaries[:self.count]))
+        data = {"count": self.count,
+            "firstOffset": summaries[0].offset,
+            "lastOffset": summaries[self.count-1].offset,
+            "ids": [c.msgid for c in self.containers],
+            "positions": array.array('l', [-1 if c.summary is None
+                else positions[c.summary] for c in self.containers]),
+            "parents": array.array('l', [-1 if c.parent is None
+                else index[c.parent] for c in self.containers]),
+            "subjects": dict((subject, index[c])
+                for subject, c in self.bySubject.items())}
+        if cache.save(box.path, data, "threads"):
+            self.dirty = False
+
+    def _adopt(self, summaries):
+        """Take the forest from the saved data, if it covers the first
+        messages of summaries. Returns True on success."""
+        data, self.saved = self.saved, None
+        if not data:
+            return False
+        n = data["count"]
+        if not n or n > len(summaries) or \
+                summaries[0].offset != data["firstOffset"] or \
+                summaries[n-1].offset != data["lastOffset"]:
+            return False
+        self.reset(summaries)
+        containers = self.containers
+        for msgid, pos in zip(data["ids"], data["positions"]):
+            c = Container(msgid)
+            containers.append(c)
+            if msgid and msgid not in self.byId:
+                self.byId[msgid] = c
+            if pos >= 0:
+                c.summary = summaries[pos]
+                self.nodes[c.summary] = c
+        for c, parent in zip(containers, data["parents"]):
+            if parent >= 0:
+                c.parent = containers[parent]
+                c.parent.children.append(c)
+        self.bySubject = dict((subject, containers[i])
+            for subject, i in data["subjects"].items())
+        self.count = n
+        self.dirty = False
+        return True
+
+    def sync(self):
+        """Bring the forest up to date with the mailbox. Messages
+        appended since the last time are added; if the summary list
+        has been replaced, the forest is rebuilt."""
+        summaries = self.box.summaries() or []
+        if summaries is not self.source or self.count > len(summaries):
+            if not self._adopt(summaries):
+                self.reset(summaries)
+        if self.count < len(summaries):
+            for summary in summaries[self.count:]:
+                self.add(summary)
+            self.count = len(summaries)
+            self.dirty = True
+        return self
+
+    def _container(self, msgid, register=True):
+        c = Container(msgid)
+        self.containers.append(c)
+        if msgid and register:
+            self.byId[msgid] = c
+        return c
+
+    @staticmethod
+    def _link(parent, child):
+        if child.parent is not None:
+            child.parent.children.remove(child)
+        child.parent = parent
+        parent.children.append(child)
+
+    @staticmethod
+    def _above(a, b):
+        """True if a is b or one of its ancestors."""
+        while b is not None:
+            if b is a:
+                return True
+            b = b.parent
+        return False
+
+    @staticmethod
+    def top(c):
+        while c.parent is not None:
+            c = c.parent
+        return c
+
+    def add(self, summary):
+        """Thread one message."""
+        msgid = msgindex.normalize(summary.MessageId)
+        c = self.byId.get(msgid) if msgid else None
+        if c is None or c.summary is not None:
+            # (A second message with the same ID gets a container of
+            # its own, which can't be referred to.)
+            c = self._container(msgid, c is None)
+        c.summary = summary
+        self.nodes[summary] = c
+        refs = msgindex.msgid_re.findall(summary.References or "")
+        parent = msgindex.parentId(summary.InReplyTo, summary.References)
+        if parent and parent not in refs[-1:]:
+            refs.append(parent)
+        # Link the references into a chain, leaving existing links
+        # alone, then put the message under the last of them.
+        prev = None
+        for ref in refs:
+            r = self.byId.get(ref) or self._container(ref)
+            if prev is not None and r.parent is None and \
+                    not self._above(r, prev):
+                self._link(prev, r)
+            prev = r
+        if prev is not None and prev is not c.parent and \
+                not self._above(c, prev):
+            self._link(prev, c)
+        subject = normalizeSubject(summary.Subject)
+        if not subject:
+            return
+        first = self.bySubject.get(subject)
+        if first is None:
+            self.bySubject[subject] = c
+        elif reply_re.match(summary.Subject):
+            top = self.top(c)
+            if (top is c or top.summary is None) and \
+                    not self._above(top, first):
+                self._link(first, top)
+
+    def thread(self, summary):
+        """Return all the messages in the thread of this one."""
+        stack = [self.top(self.nodes[summary])]
+        result = []
+        while stack:
+            c = stack.pop()
+            if c.summary is not None:
+                result.append(c.summary)
+            stack.extend(c.children)
+        return result
+
+    def flatten(self, summaries, collapsed=()):
+        """Arrange summaries, which must all be messages of the
+        mailbox, in threads. Threads are in order of their first
+        message's date, and each is depth first, replies in date
+        order. Containers whose message isn't in summaries are
+        skipped, their replies taking their place. Returns the list,
+        and a dict mapping each message in it to (depth, top,
+        hidden), where top is the thread's top container. Of a thread
+        whose top is in collapsed, only the first message is listed,
+        with hidden the number of others."""
+        shown = set(summaries)
+        tops = []
+        seen = set()
+        for summary in summaries:
+            top = self.top(self.nodes[summary])
+            if top not in seen:
+                seen.add(top)
+                tops.append(top)
+        dates = {}
+        def date(c):
+            if c not in dates:
+                dates[c] = (c.summary.udate or 0) if c.summary is not None \
+                    else min([date(k) for k in c.children] or [0])
+            return dates[c]
+        threads = []
+        for top in tops:
+            rows = []
+            stack = [(top, 0)]
+            while stack:
+                c, depth = stack.pop()
+                if c.summary in shown:
+                    rows.append((c.summary, depth))
+                    depth += 1
+                if c.children:
+                    stack.extend((k, depth) for k in
+                        sorted(c.children, key=date, reverse=True))
+            threads.append((min(s.udate or 0 for s,d in rows), top, rows))
+        threads.sort(key=lambda t: t[0])
+        result = []
+        info = {}
+        for udate, top, rows in threads:
+            if top in collapsed:
+                summary, depth = rows[0]
+                result.append(summary)
+                info[summary] = (depth, top, len(rows) - 1)
+                continue
+            for summary, depth in rows:
+                result.append(summary)
+                info[summary] = (min(depth, MAXDEPTH), top, 0)
+        return result, info
+
+
+def get(box):
+    """Return the thread forest for this mailbox, up to date, loading
+    it from the cache the first time."""
+    forest = getattr(box, "_threads", None)
+    if forest is None:
+        forest = box._threads = Forest(box)
+        forest.load()
+        box.addListener(_update)
+    return forest.sync()
+
+def _update(box, event, summary):
+    """Listener which saves the forest when the mailbox saves its
+    summaries."""
+    forest = getattr(box, "_threads", None)
+    if forest is not None and event == "saved":
+        forest.sync().save()
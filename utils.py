@@ -3,8 +3,11 @@
 
 from __future__ import print_function
 
+import string
 import sys
 
+import charsets
+
 PY3 = sys.version_info[0] >= 3
 if PY3:
     basestring = str
@@ -67,25 +70,23 @@ def fromUTF(s):
         s = s.decode('utf-8')
     return s
 
-def toU(s):
+def toU(s, sender=None):
     """Try to convert this string to unicode. There's a lot of
     bullshit encodings out there in email land, and sometimes you
-    just have to guess."""
-    encodings = ["utf8", "GB2312", "HZ-GB-2312",
-        "ISO-8859-5", "windows-1251",
-        "ISO-8859-1", "windows-1252",
-        "ISO-8859-7", "windows-1253",
-        "ISO-8859-8", "windows-1255",]
+    just have to guess; see charsets. sender is the sender's address,
+    if known."""
+    if not isinstance(s, bytes):
+        return s
     try:
-        return unicode(s)
-    except:
-        for encoding in encodings:
-            try:
-                return s.decode(encoding)
-            except:
-                pass
+        return s.decode("ascii")
+    except UnicodeDecodeError:
+        pass
+    rval = charsets.decode(s, sender)
+    if rval is not None:
+        return rval
     # Hopeless
-    rval = [c if c in string.printable else ("\\%2.2x" % ord(c)) for c in s]
+    rval = [chr(c) if chr(c) in string.printable else ("\\%2.2x" % c)
+        for c in bytearray(s)]
     return u''.join(rval)
 
 def human_readable(num, divisor=1024):
@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Virtual folders: saved searches, and unified views of several
+mailboxes. A saved search is defined by a section in .trmrc:
+
+    [search "team"]
+    query = unread from:alice@example.com,bob@example.com
+    folders = inbox, lists
+
+folders is optional; the default is every mailbox in the account.
+The query is a list of terms, all of which must match. A term
+preceded by '-' must not match. Terms are:
+
+    unread read new flagged answered deleted
+    direct cc                           addressed to you, or copied to
+                                        you; see addresses in [global]
+    from:text to:text subject:text      contains text, ignoring case;
+                                        use text1,text2 for either
+    days:n                              arrived in the last n days
+
+The members are found by examining every message once, the first
+time the folder is opened. After that, membership is kept up to
+date from the append and flag-change events of the underlying
+mailboxes, so re-opening the folder is immediate.
+
+A unified folder shows all the messages of several mailboxes in
+date order:
+
+    [unified "all mail"]
+    folders = inbox, lists
+
+The combined list is never built. It is a k-way merge of the
+mailboxes' own date-ordered summaries, done lazily from whichever
+end of the list is being looked at, so only the rows which are
+actually displayed (or passed over by e.g. next-unread) are
+merged."""
+
+from __future__ import print_function
+
+import heapq
+import shlex
+import sys
+import time
+
+import emailaccount
+from emailaccount import messageSummary
+from utils import writeLog, configGet
+
+PY3 = sys.version_info[0] >= 3
+
+FLAGS = {
+    "unread": (messageSummary.FLAG_READ, False),
+    "read": (messageSummary.FLAG_READ, True),
+    "new": (messageSummary.FLAG_NEW, True),
+    "flagged": (messageSummary.FLAG_FLAGGED, True),
+    "answered": (messageSummary.FLAG_ANSWERED, True),
+    "deleted": (messageSummary.FLAG_DELETED, True),
+    "direct": (messageSummary.FLAG_DIRECT, True),
+    "cc": (messageSummary.FLAG_CC, True),
+}
+FIELDS = {"from": "From", "to": "To", "subject": "Subject"}
+
+
+def compileQuery(query):
+    """Return a function(summary) which returns True if the message
+    matches the query. Raises ValueError if the query is bad."""
+    tests = []
+    for term in shlex.split(query):
+        negate = term.startswith('-')
+        if negate:
+            term = term[1:]
+        field, _, value = term.partition(':')
+        field = field.lower()
+        if not value and field in FLAGS:
+            test = _flagTest(*FLAGS[field])
+        elif value and field in FIELDS:
+            test = _fieldTest(FIELDS[field], value)
+        elif value and field == "days":
+            try:
+                test = _daysTest(float(value))
+            except ValueError:
+                raise ValueError("bad number of days in %s" % term)
+        else:
+            raise ValueError("unknown search term %s" % term)
+        tests.append(_negate(test) if negate else test)
+    return lambda summary: all(test(summary) for test in tests)
+
+def _flagTest(flag, isSet):
+    return lambda summary: bool(summary.status & flag) == isSet
+
+def _fieldTest(attr, value):
+    values = [v.lower() for v in value.split(',') if v]
+    def test(summary):
+        text = (getattr(summary, attr) or u"").lower()
+        for v in values:
+            if v in text:
+                return True
+        return False
+    return test
+
+def _daysTest(days):
+    return lambda summary: (summary.udate or 0) >= time.time() - days*86400
+
+def _negate(test):
+    return lambda summary: not test(summary)
+
+
+class VirtualFolder(emailaccount.mailbox):
+    """A mailbox whose messages are those in other mailboxes of the
+    account which match a query. The message list shown is a
+    snapshot taken by getOverview(); messages which stop matching,
+    e.g. because they have been read, stay in it until the folder
+    is next opened or refreshed."""
+    def __init__(self, account, name, query, folders=None):
+        super(VirtualFolder,self).__init__(name, None)
+        self.account = account
+        self.query = query
+        self.predicate = compileQuery(query)
+        self.folders = folders          # mailbox names, or None for all
+        self.sources = []               # mailboxes being watched
+        self.members = {}               # summary => owning mailbox
+        self.owners = {}                # same, for the snapshot
+        self.positions = {}             # summary => position in snapshot
+        self._summaries = []
+        self.msgdict = {}
+        self.nUnread = 0
+        self.nNew = 0
+        self.modified = False
+    def __str__(self):
+        return "%s (search)" % self.name
+    def ownerOf(self, summary):
+        return self.owners.get(summary, self)
+    def positionOf(self, summary):
+        return self.positions[summary]
+
+    def getOverview(self, callback):
+        """Bring the underlying mailboxes up to date, then take a
+        snapshot of the members. callback(mbox, count, pct, status,
+        msg) is passed along to the underlying mailboxes' getOverview(),
+        but with this folder as the mailbox."""
+        sources = resolve(self)
+        if [id(box) for box in sources] != [id(box) for box in self.sources]:
+            self._attach(sources)
+        status = self.STATE_FINISHED
+        def relay(box, count, pct, boxStatus, msg):
+            if callback and boxStatus == self.STATE_READING:
+                callback(self, count, pct, boxStatus, msg)
+        for box in sources:
+            if box.state != self.STATE_FINISHED or \
+                    box.checkForUpdates() != self.NO_UPDATES:
+                status = box.getOverview(relay)
+                if status != self.STATE_FINISHED:
+                    break
+        # Time passing can take messages out of the folder, so check
+        # the members again; this costs time in proportion to the
+        # size of the folder, not the mailboxes.
+        for summary in [s for s in self.members if not self.predicate(s)]:
+            del self.members[summary]
+        self._snapshot()
+        self.updates = self.NO_UPDATES
+        self._state = status
+        if callback:
+            callback(self, len(self._summaries), 100., status, None)
+        return status
+
+    def _attach(self, sources):
+        """Start watching these mailboxes, and find the matching
+        messages they already have."""
+        for box in self.sources:
+            box.removeListener(self.update)
+        self.sources = sources
+        self.members = {}
+        for box in sources:
+            box.addListener(self.update)
+            self._rescan(box)
+
+    def _rescan(self, box):
+        for summary in [s for s,b in self.members.items() if b is box]:
+            del self.members[summary]
+        predicate = self.predicate
+        for summary in box.summaries() or ():
+            if predicate(summary):
+                self.members[summary] = box
+
+    def update(self, box, event, summary):
+        """Listener for changes to the underlying mailboxes."""
+        if event == "reset" or event == "flags" and summary is None:
+            self._rescan(box)
+        elif event != "append" and event != "flags":
+            return
+        elif self.predicate(summary):
+            self.members[summary] = box
+        else:
+            self.members.pop(summary, None)
+
+    def _snapshot(self):
+        summaries = sorted(self.members, key=lambda s: s.udate or 0)
+        self.owners = dict(self.members)
+        self.positions = dict((s, i) for i,s in enumerate(summaries))
+        self._summaries = summaries
+        self.msgdict = dict((s.key, s) for s in summaries)
+        self.nNew = self.nUnread = 0
+        for summary in summaries:
+            self._count(summary.status, 1)
+
+    def _count(self, status, delta):
+        if status & messageSummary.FLAG_DELETED:
+            return
+        if status & messageSummary.FLAG_NEW: self.nNew += delta
+        if not (status & messageSummary.FLAG_READ): self.nUnread += delta
+
+    def checkForUpdates(self):
+        for box in self.sources:
+            if box.checkForUpdates() != self.NO_UPDATES:
+                self.updates = self.BOX_APPENDED
+        return self.updates
+
+    def chFlagsSummary(self, summary, toSet, toClear, toToggle=0):
+        box = self.owners.get(summary)
+        if box is None:
+            return self
+        status = summary.status
+        box.chFlagsSummary(summary, toSet, toClear, toToggle)
+        self._count(status, -1)
+        self._count(summary.status, 1)
+        self.modified = True
+        if summary.status != status:
+            self._notify("flags", summary)
+        return self
+
+    def chFlagsMany(self, summaries, toSet, toClear, toToggle=0):
+        changed = _chFlagsOwners(self, summaries, toSet, toClear, toToggle)
+        for summary, status in changed:
+            self._count(status, -1)
+            self._count(summary.status, 1)
+        self.modified = True
+        for summary, status in changed:
+            self._notify("flags", summary)
+        return len(changed)
+
+    def chFlagsRange(self, start, end, toSet, toClear, toToggle=0):
+        return self.chFlagsMany(self._summaries[max(start, 0):end],
+            toSet, toClear, toToggle)
+
+    def getMessage(self, n):
+        if n < 0 or n >= len(self._summaries):
+            return None
+        summary = self._summaries[n]
+        return summary.getMessage(self.ownerOf(summary))
+
+    def limitTo(self, kind, key):
+        # Positions in the underlying mailboxes are no use here, but
+        # a virtual folder is small enough to simply look.
+        return [s for s in self._summaries
+            if not (s.status & messageSummary.FLAG_DELETED) and
+                key in self.limitKeys(kind, s)]
+
+    def unreadWithSubject(self, summary, direction=1):
+        # Scans, as limitTo() does
+        pos = self.positions.get(summary)
+        keys = self.limitKeys("subject", summary)
+        if pos is None or not keys:
+            return
+        summaries = self._summaries
+        rng = range(pos+1, len(summaries)) if direction > 0 else \
+            range(pos-1, -1, -1)
+        for i in rng:
+            s = summaries[i]
+            if not s.status & (messageSummary.FLAG_READ |
+                    messageSummary.FLAG_DELETED) and \
+                    self.limitKeys("subject", s) == keys:
+                yield s
+
+
+def resolve(folder):
+    """Return the mailboxes a virtual folder draws from."""
+    boxes = folder.account.boxes
+    if folder.folders is None:
+        return list(boxes)
+    byName = dict((box.name.lower(), box) for box in boxes)
+    rval = []
+    for name in folder.folders:
+        if name.lower() in byName:
+            rval.append(byName[name.lower()])
+        else:
+            writeLog("%s: no mailbox %s" % (folder, name))
+    return rval
+
+def _chFlagsOwners(folder, summaries, toSet, toClear, toToggle):
+    """Change the flags of these messages of the folder all at once
+    in each mailbox which holds some of them. Returns (summary, old
+    status) for each message whose flags changed."""
+    byOwner = {}
+    status = {}
+    for summary in summaries:
+        box = folder.ownerOf(summary)
+        if box is not folder:
+            byOwner.setdefault(box, []).append(summary)
+            status[summary] = summary.status
+    for box, group in byOwner.items():
+        box.chFlagsMany(group, toSet, toClear, toToggle)
+    return [(s, status[s]) for s in summaries
+        if s in status and s.status != status[s]]
+
+def _udate(summary):
+    return summary.udate or 0
+
+class MergedList(object):
+    """Sequence which merges several lists, each already ordered
+    by key, without building the result. Rows are merged on demand,
+    from the front or the back of the sequence, whichever is nearer
+    the row asked for. Each list's length is taken when the
+    MergedList is created; anything appended later is not seen.
+    Ties are broken by list, then by position in the list.
+
+    If setClient is true, each row's summary.client is set to its
+    position as it is merged, as SetView() does for ordinary lists."""
+    def __init__(self, lists, key=_udate, setClient=False):
+        self.lists = [(lst, len(lst)) for lst in lists]
+        self.key = key
+        self.setClient = setClient
+        self.head = []          # rows merged from the front
+        self.tail = []          # rows merged from the back, last first
+        self._len = sum(n for lst,n in self.lists)
+        self._fwd = [(key(lst[0]), k, 0)
+            for k,(lst,n) in enumerate(self.lists) if n]
+        self._bwd = [(-key(lst[n-1]), -k, 1-n)
+            for k,(lst,n) in enumerate(self.lists) if n]
+        heapq.heapify(self._fwd)
+        heapq.heapify(self._bwd)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._len))]
+        n = self._len
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("MergedList index out of range")
+        head, tail = self.head, self.tail
+        if i < len(head):
+            return head[i]
+        j = n - 1 - i
+        if j < len(tail):
+            return tail[j]
+        if i - len(head) <= j - len(tail):
+            while len(head) <= i:
+                self._advance()
+            return head[i]
+        while len(tail) <= j:
+            self._retreat()
+        return tail[j]
+
+    def _advance(self):
+        key, k, pos = heapq.heappop(self._fwd)
+        lst, n = self.lists[k]
+        summary = lst[pos]
+        if pos + 1 < n:
+            heapq.heappush(self._fwd, (self.key(lst[pos+1]), k, pos+1))
+        if self.setClient:
+            summary.client = len(self.head)
+        self.head.append(summary)
+
+    def _retreat(self):
+        key, k, pos = heapq.heappop(self._bwd)
+        k, pos = -k, -pos
+        lst, n = self.lists[k]
+        summary = lst[pos]
+        if pos > 0:
+            heapq.heappush(self._bwd, (-self.key(lst[pos-1]), -k, 1-pos))
+        if self.setClient:
+            summary.client = self._len - 1 - len(self.tail)
+        self.tail.append(summary)
+
+    def __delitem__(self, i):
+        """Remove a row from the sequence; the lists are not touched."""
+        summary = self[i]       # Make sure it has been merged
+        if i < 0:
+            i += self._len
+        if i < len(self.head):
+            del self.head[i]
+            moved = self.head[i:] + self.tail
+        else:
+            j = self._len - 1 - i
+            del self.tail[j]
+            moved = self.tail[:j]
+        self._len -= 1
+        if self.setClient:
+            summary.client = None
+            for row in moved:
+                row.client -= 1
+
+    def forget(self):
+        """Clear summary.client of the rows merged so far."""
+        for summary in self.head + self.tail:
+            summary.client = None
+
+
+class UnifiedFolder(emailaccount.mailbox):
+    """A mailbox whose messages are all those of several other
+    mailboxes of the account, in date order. Flag changes are passed
+    to the mailbox which holds the message."""
+    def __init__(self, account, name, folders=None):
+        super(UnifiedFolder,self).__init__(name, None)
+        self.account = account
+        self.folders = folders          # mailbox names, or None for all
+        self.sources = []
+        self.orders = {}                # mailbox => (summaries, n, ordered)
+        # mailbox => (ordered, n, those of ordered[:n] not deleted,
+        # set of those deleted)
+        self.undeleted = {}
+        self.positions = None           # (summaries, summary => position)
+        self._summaries = MergedList([])
+        self.msgdict = {}
+        self.nUnread = 0
+        self.nNew = 0
+        self.modified = False
+    def __str__(self):
+        return "%s (unified)" % self.name
+    def positionOf(self, summary):
+        # Only needed for sorting, which looks at every message anyway
+        if self.positions is None or self.positions[0] is not self._summaries:
+            self.positions = (self._summaries,
+                dict((s, i) for i,s in enumerate(self._summaries)))
+        return self.positions[1][summary]
+    def ownerOf(self, summary):
+        idx = summary.idx
+        for box in self.sources:
+            summaries = box.summaries()
+            if summaries and idx < len(summaries) and summaries[idx] is summary:
+                return box
+        return self
+
+    def getOverview(self, callback):
+        """Bring the underlying mailboxes up to date. callback(mbox,
+        count, pct, status, msg) is passed along to their getOverview(),
+        but with this folder as the mailbox."""
+        sources = resolve(self)
+        if [id(box) for box in sources] != [id(box) for box in self.sources]:
+            for box in self.sources:
+                box.removeListener(self.update)
+            self.sources = sources
+            self.undeleted = {}
+            for box in sources:
+                box.addListener(self.update)
+        status = self.STATE_FINISHED
+        def relay(box, count, pct, boxStatus, msg):
+            if callback and boxStatus == self.STATE_READING:
+                callback(self, count, pct, boxStatus, msg)
+        for box in self.sources:
+            if box.state != self.STATE_FINISHED or \
+                    box.checkForUpdates() != self.NO_UPDATES:
+                status = box.getOverview(relay)
+                if status != self.STATE_FINISHED:
+                    break
+        self._summaries = self.mergedView(True, False)
+        self._count()
+        self.updates = self.NO_UPDATES
+        self._state = status
+        if callback:
+            callback(self, len(self._summaries), 100., status, None)
+        return status
+
+    def ordered(self, box):
+        """Return this mailbox's summaries in date order. Mail is
+        usually filed in date order, in which case this is the
+        mailbox's own list; otherwise a sorted copy is kept."""
+        summaries = box.summaries() or []
+        n = len(summaries)
+        cached = self.orders.get(box)
+        if cached and cached[0] is summaries and cached[1] == n:
+            return cached[2]
+        for i in range(1, n):
+            if _udate(summaries[i]) < _udate(summaries[i-1]):
+                ordered = sorted(summaries[:n], key=_udate)
+                break
+        else:
+            ordered = summaries
+        self.orders[box] = (summaries, n, ordered)
+        return ordered
+
+    def mergedView(self, showDeleted, setClient=True):
+        """Return a new MergedList of the messages, optionally leaving
+        out those flagged deleted."""
+        if showDeleted:
+            lists = [self.ordered(box) for box in self.sources]
+        else:
+            lists = [self.notDeleted(box) for box in self.sources]
+        return MergedList(lists, _udate, setClient)
+
+    def notDeleted(self, box):
+        """Return ordered(box) less the messages flagged deleted. The
+        list is kept, and only new mail is looked at next time, unless
+        a message is deleted or undeleted, which update() notices."""
+        ordered = self.ordered(box)
+        n = len(ordered)
+        cached = self.undeleted.get(box)
+        if cached and cached[0] is ordered and cached[1] <= n:
+            ordered, start, kept, deleted = cached
+        else:
+            start, kept, deleted = 0, [], set()
+        FLAG_DELETED = messageSummary.FLAG_DELETED
+        for summary in ordered[start:n]:
+            if summary.status & FLAG_DELETED:
+                deleted.add(summary)
+            else:
+                kept.append(summary)
+        self.undeleted[box] = (ordered, n, kept, deleted)
+        return kept
+
+    def update(self, box, event, summary):
+        """Listener for changes to the underlying mailboxes; drops
+        the list of messages not deleted if it no longer holds."""
+        cached = self.undeleted.get(box)
+        if not cached:
+            return
+        if event == "reset" or event == "flags" and (summary is None or
+                bool(summary.status & messageSummary.FLAG_DELETED) != \
+                (summary in cached[3])):
+            del self.undeleted[box]
+
+    def _count(self):
+        self.nNew = sum(box.nNew or 0 for box in self.sources)
+        self.nUnread = sum(box.nUnread or 0 for box in self.sources)
+
+    def checkForUpdates(self):
+        for box in self.sources:
+            if box.checkForUpdates() != self.NO_UPDATES:
+                self.updates = self.BOX_APPENDED
+        return self.updates
+
+    def chFlagsSummary(self, summary, toSet, toClear, toToggle=0):
+        box = self.ownerOf(summary)
+        if box is self:
+            return self
+        status = summary.status
+        box.chFlagsSummary(summary, toSet, toClear, toToggle)
+        self._count()
+        self.modified = True
+        if summary.status != status:
+            self._notify("flags", summary)
+        return self
+
+    def chFlagsMany(self, summaries, toSet, toClear, toToggle=0):
+        changed = _chFlagsOwners(self, summaries, toSet, toClear, toToggle)
+        self._count()
+        self.modified = True
+        for summary, status in changed:
+            self._notify("flags", summary)
+        return len(changed)
+
+    def chFlagsRange(self, start, end, toSet, toClear, toToggle=0):
+        summaries = self._summaries
+        return self.chFlagsMany([summaries[i] for i in
+            range(max(start, 0), min(end, len(summaries)))],
+            toSet, toClear, toToggle)
+
+    def getMessage(self, n):
+        if n < 0 or n >= len(self._summaries):
+            return None
+        summary = self._summaries[n]
+        return summary.getMessage(self.ownerOf(summary))
+
+    def limitTo(self, kind, key):
+        # Merge the results of the underlying indexes
+        lists = [sorted(box.limitTo(kind, key), key=_udate)
+            for box in self.sources]
+        return MergedList(lists)[:]
+
+    def unreadWithSubject(self, summary, direction=1):
+        # Only the messages in the same mailbox are followed
+        box = self.ownerOf(summary)
+        if box is self:
+            return iter(())
+        return box.unreadWithSubject(summary, direction)
+
+    def dateRange(self, start=None, end=None):
+        return MergedList([box.dateRange(start, end)
+            for box in self.sources])[:]
+
+    def datesFrom(self, start):
+        return iter(MergedList([box.dateRange(start)
+            for box in self.sources]))
+
+
+def fromConfig(account, config):
+    """Return the list of virtual folders defined in the config."""
+    searches = []
+    for section in config.sections():
+        if section.startswith("search "):
+            kind = "search"
+        elif section.startswith("unified "):
+            kind = "unified"
+        else:
+            continue
+        name = section[len(kind):].strip().strip('"')
+        folders = configGet(config, section, "folders")
+        if folders is not None:
+            folders = [f.strip() for f in folders.split(',') if f.strip()]
+        if kind == "unified":
+            searches.append(UnifiedFolder(account, name, folders))
+            continue
+        query = configGet(config, section, "query")
+        try:
+            searches.append(VirtualFolder(account, name, query or "", folders))
+        except ValueError as e:
+            writeLog("search %s: %s" % (name, e))
+    return searches